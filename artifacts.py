@@ -0,0 +1,172 @@
+import csv
+import io
+import json
+import os
+import threading
+import zipfile
+import numpy as np
+
+
+def format_times(times, separator = ','):
+    '''
+    Convert an array of seconds to hh:mm:ss,mss (SRT) or hh:mm:ss.mss with separator '.' (WebVTT)
+    '''
+    times = np.asarray(times, dtype=float)
+    hours = (times // 3600).astype(int)
+    minutes = ((times % 3600) // 60).astype(int)
+    seconds = ((times % 60) // 1).astype(int)
+    miliseconds = (((times + 1e-9) % 1.0) // 0.001).astype(int)
+    return [f'{h:02d}:{m:02d}:{s:02d}{separator}{ms:03d}' for h, m, s, ms in
+            zip(hours.tolist(), minutes.tolist(), seconds.tolist(), miliseconds.tolist())]
+
+
+class SubtitleWriter:
+    '''
+    Subtitle file built in memory. add() appends the entries of a batch as soon as it is ready,
+    numbered after the previous ones, and getvalue() gives the file so far at any time.
+    '''
+    extension = ''
+    encoding = 'utf-8'
+
+    def __init__(self):
+        self.buffer = io.StringIO()
+        self.buffer.write(self.header())
+        self.count = 0
+
+    def header(self):
+        return ''
+
+    def footer(self):
+        return ''
+
+    def write_entries(self, numbers, starts, ends, texts):
+        raise NotImplementedError
+
+    def add(self, starts, ends, texts):
+        '''
+        Append entries from starts and ends in seconds
+        '''
+        numbers = range(self.count + 1, self.count + len(texts) + 1)
+        self.write_entries(numbers, starts, ends, texts)
+        self.count += len(texts)
+
+    def getvalue(self):
+        return self.buffer.getvalue() + self.footer()
+
+    def getbytes(self):
+        return self.getvalue().encode(self.encoding)
+
+
+class SRTWriter(SubtitleWriter):
+    extension = 'srt'
+
+    def footer(self):
+        return '\n'
+
+    def write_entries(self, numbers, starts, ends, texts):
+        self.buffer.write(''.join([f'{number}\n{start} --> {end}\n{text}\n\n' for number, start, end, text in
+                                   zip(numbers, format_times(starts), format_times(ends), texts)]))
+
+
+class VTTWriter(SubtitleWriter):
+    extension = 'vtt'
+
+    def header(self):
+        return 'WEBVTT\n\n'
+
+    def write_entries(self, numbers, starts, ends, texts):
+        self.buffer.write(''.join([f'{number}\n{start} --> {end}\n{text}\n\n' for number, start, end, text in
+                                   zip(numbers, format_times(starts, '.'), format_times(ends, '.'), texts)]))
+
+
+class CSVWriter(SubtitleWriter):
+    '''
+    Rows of number, start, end and text, with a BOM so that Excel reads the file as UTF-8
+    '''
+    extension = 'csv'
+    encoding = 'utf_8_sig'
+
+    def write_entries(self, numbers, starts, ends, texts):
+        writer = csv.writer(self.buffer, lineterminator='\n')
+        writer.writerows([[number, start, end, text] for number, start, end, text in
+                          zip(numbers, format_times(starts), format_times(ends), texts)])
+
+
+class JSONWriter(SubtitleWriter):
+    '''
+    {"segments": [{"id", "start", "end", "text"}, ...]} with start and end in seconds
+    '''
+    extension = 'json'
+
+    def header(self):
+        return '{"segments": ['
+
+    def footer(self):
+        return '\n]}\n'
+
+    def write_entries(self, numbers, starts, ends, texts):
+        for number, start, end, text in zip(numbers, np.asarray(starts, dtype=float).tolist(),
+                                            np.asarray(ends, dtype=float).tolist(), texts):
+            segment = {'id': number, 'start': round(start, 3), 'end': round(end, 3), 'text': text}
+            self.buffer.write((',\n' if number > 1 else '\n') + json.dumps(segment, ensure_ascii=False))
+
+
+WRITERS = {'srt': SRTWriter, 'csv': CSVWriter, 'vtt': VTTWriter, 'json': JSONWriter}
+
+
+class SubtitleArtifacts:
+    '''
+    Subtitle files of one job in every language and format, named <name>_<language>.<format>.
+    Batches are appended as they are translated, and the files so far can be zipped in memory
+    at any time, e.g. for a partial download during a long run. A batch is added to every language
+    under a lock, so files read by another thread hold the same batches in every language.
+    '''
+    def __init__(self, name, languages = ('ja', 'en'), formats = tuple(WRITERS)):
+        self.name = name
+        self.lock = threading.Lock()
+        self.writers = {(language, fmt): WRITERS[fmt]() for language in languages for fmt in formats}
+
+    def add(self, language, starts, ends, texts):
+        self.add_batch(starts, ends, {language: texts})
+
+    def add_batch(self, starts, ends, texts):
+        '''
+        Append one batch in several languages; texts maps each language to its lines
+        '''
+        with self.lock:
+            for (language, fmt), writer in self.writers.items():
+                if language in texts:
+                    writer.add(starts, ends, texts[language])
+
+    def files(self, extra = None):
+        '''
+        List of (file name, bytes); extra maps name suffixes such as '_summary.txt' to more text files
+        '''
+        with self.lock:
+            files = [(f'{self.name}_{language}.{writer.extension}', writer.getbytes())
+                     for (language, fmt), writer in self.writers.items()]
+        for suffix, text in (extra or {}).items():
+            files.append((self.name + suffix, text.encode('utf-8')))
+        return files
+
+    def zip_bytes(self, extra = None):
+        '''
+        Zip of the files built in memory
+        '''
+        buffer = io.BytesIO()
+        with zipfile.ZipFile(buffer, 'w', compression=zipfile.ZIP_DEFLATED) as zip:
+            for file_name, data in self.files(extra):
+                zip.writestr(file_name, data)
+        return buffer.getvalue()
+
+    def write(self, directory, extra = None):
+        '''
+        Write the files to directory and return their paths
+        '''
+        paths = []
+        for file_name, data in self.files(extra):
+            path = os.path.join(directory, file_name)
+            with open(path, 'wb') as f:
+                f.write(data)
+            paths.append(path)
+        return paths
@@ -0,0 +1,282 @@
+import os
+import re
+import ffmpeg
+import numpy as np
+from metrics import stage
+
+
+# Upload encoding: mono 16 kHz Opus is enough for speech recognition and about 1/5 of a 128 kbps MP3.
+# bitexact keeps the Ogg stream serial and encoder tag fixed, so the same audio always gives the same bytes
+# and the transcription cache, keyed by the content of the chunks, hits when it is converted again.
+AUDIO_EXT = '.ogg'
+BITEXACT = {'fflags': '+bitexact'}
+AUDIO_OPTIONS = {'ac': 1, 'ar': 16000, 'acodec': 'libopus', 'audio_bitrate': '24k', 'application': 'voip', **BITEXACT}
+
+# Longest chunk [s] even if the file is under the size limit, so that long recordings are still
+# transcribed concurrently and their first subtitles are ready early
+MAX_CHUNK_SECONDS = 600
+
+# Decoded PCM of the speech-activity prefilter: 16 kHz mono, analysed in 30 ms frames
+PCM_RATE = 16000
+FRAME_SECONDS = 0.03
+
+
+def probe(file_path):
+    '''
+    Get (duration [s], file size [M]) of an audio file
+    '''
+    info = ffmpeg.probe(file_path)
+    duration = float(info['format']['duration'])
+    file_size = float(info['format']['size'])/1e6
+    return duration, file_size
+
+
+def parse_silences(log):
+    '''
+    Get a list of silences (start, end) in seconds from the log of ffmpeg silencedetect
+    '''
+    log = log.decode('utf-8', errors='replace')
+    starts = [float(x) for x in re.findall(r'silence_start: (-?[\d.]+)', log)]
+    ends = [float(x) for x in re.findall(r'silence_end: (-?[\d.]+)', log)]
+    return [(max(0.0, start), end) for start, end in zip(starts, ends)]
+
+
+def prepare_audio(input_path, output_path, max_seconds = None, noise = '-35dB', min_silence = 0.5):
+    '''
+    Extract the audio of an MP3 or MP4 file in a single ffmpeg pass:
+    drop video, downmix to the upload encoding (AUDIO_OPTIONS) and detect silences at the same time.
+    Only the first max_seconds are used if given. Return the list of silences.
+    '''
+    if max_seconds is None:
+        stream = ffmpeg.input(input_path)
+    else:
+        stream = ffmpeg.input(input_path, t=max_seconds)
+    split = stream.audio.filter_multi_output('asplit')
+    encoded = ffmpeg.output(split[0], output_path, **AUDIO_OPTIONS)
+    detected = ffmpeg.output(split[1].filter('silencedetect', noise=noise, d=min_silence), '-', format='null')
+    _, log = ffmpeg.merge_outputs(encoded, detected).run(capture_stderr=True, overwrite_output=True)
+    return parse_silences(log)
+
+
+def plan_chunks(duration, file_size, silences, max_file_size = 24, min_chunk = 60.0, max_chunk_seconds = None):
+    '''
+    Plan chunks (start, end) in seconds whose sizes are under max_file_size [M]
+    and whose durations are under max_chunk_seconds if given.
+    Each cut is placed in the middle of the latest silence before the limit,
+    or at the limit if there is no silence after min_chunk seconds of the chunk.
+    '''
+    # Longest chunk under the size limit, assuming a constant bitrate
+    max_duration = duration * max_file_size / file_size if file_size > 0 else duration
+    if max_chunk_seconds is not None:
+        max_duration = min(max_duration, max_chunk_seconds)
+    if duration <= max_duration:
+        return [(0.0, duration)]
+
+    cut_points = [(start + end) / 2 for start, end in silences]
+
+    chunks = []
+    start = 0.0
+    while duration - start > max_duration:
+        limit = start + max_duration
+        candidates = [cut for cut in cut_points if start + min_chunk < cut <= limit]
+        end = candidates[-1] if candidates else limit
+        chunks.append((start, end))
+        start = end
+    chunks.append((start, duration))
+    return chunks
+
+
+def split_audio(file_path, chunks):
+    '''
+    Write the chunks of an audio file to <name>N<ext> without overlap and return their paths.
+    All chunks are written by one ffmpeg pass with the segment muxer and without re-encoding.
+    '''
+    if len(chunks) == 1:
+        return [file_path]
+
+    base, ext = os.path.splitext(file_path)
+    segment_times = ','.join('{:.3f}'.format(start) for start, end in chunks[1:])
+    stream = ffmpeg.input(file_path)
+    stream = ffmpeg.output(stream, base + '%d' + ext, format='segment', segment_times=segment_times,
+                           reset_timestamps=1, acodec='copy', **BITEXACT)
+    ffmpeg.run(stream, overwrite_output=True)
+    return [base + str(i) + ext for i in range(len(chunks))]
+
+
+def iter_pcm(file_path, block_seconds = 60.0, max_seconds = None):
+    '''
+    Decode the audio of a file to 16-bit PCM at PCM_RATE and yield it in blocks of block_seconds,
+    so that long recordings are never held in memory at once. Only the first max_seconds are decoded if given.
+    '''
+    stream = ffmpeg.input(file_path) if max_seconds is None else ffmpeg.input(file_path, t=max_seconds)
+    process = (stream.audio.output('pipe:', format='s16le', ac=1, ar=PCM_RATE)
+               .global_args('-loglevel', 'error').run_async(pipe_stdout=True))
+    block_size = int(block_seconds * PCM_RATE) * 2
+    try:
+        while True:
+            data = process.stdout.read(block_size)
+            if not data:
+                break
+            yield np.frombuffer(data[:len(data) // 2 * 2], dtype=np.int16)
+    finally:
+        process.stdout.close()
+        if process.wait() != 0:
+            raise ffmpeg.Error('ffmpeg', None, None)
+
+
+def frame_energies(file_path, frame_seconds = FRAME_SECONDS, max_seconds = None):
+    '''
+    Energy [dBFS] of each frame of the audio of a file (only the first max_seconds if given)
+    '''
+    frame = int(frame_seconds * PCM_RATE)
+    energies = []
+    for samples in iter_pcm(file_path, max_seconds = max_seconds):
+        n = len(samples) // frame * frame
+        x = samples[:n].astype(np.float32).reshape(-1, frame) / 32768.0
+        energies.append(10 * np.log10(np.mean(x * x, axis=1) + 1e-10))
+    return np.concatenate(energies) if energies else np.empty(0)
+
+
+def detect_speech(energies, frame_seconds = FRAME_SECONDS, margin_db = 10.0, min_db = -50.0, padding = 0.3,
+                  min_silence = 2.0):
+    '''
+    Speech spans (start, end) in seconds from frame energies.
+    A frame is speech if it is margin_db over the noise floor (10th percentile of the frames) and over min_db.
+    Speech is extended by padding seconds on both sides, and only non-speech of min_silence seconds or more
+    separates two spans.
+    '''
+    if len(energies) == 0:
+        return []
+    threshold = max(np.percentile(energies, 10) + margin_db, min_db)
+    speech = energies > threshold
+    pad = int(round(padding / frame_seconds))
+    if pad > 0:
+        speech = np.convolve(speech.astype(np.int32), np.ones(2 * pad + 1, dtype=np.int32), mode='same') > 0
+    edges = np.diff(np.concatenate([[0], speech.astype(np.int8), [0]]))
+    starts = np.flatnonzero(edges == 1) * frame_seconds
+    ends = np.flatnonzero(edges == -1) * frame_seconds
+    if len(starts) == 0:
+        return []
+    keep = starts[1:] - ends[:-1] >= min_silence
+    starts = np.concatenate([starts[:1], starts[1:][keep]])
+    ends = np.concatenate([ends[:-1][keep], ends[-1:]])
+    return list(zip(starts.tolist(), ends.tolist()))
+
+
+def find_silences(energies, frame_seconds = FRAME_SECONDS, noise_db = -35.0, min_silence = 0.5):
+    '''
+    Silences (start, end) in seconds from frame energies, like ffmpeg silencedetect with noise=noise_db dB
+    and d=min_silence
+    '''
+    quiet = np.asarray(energies) < noise_db
+    edges = np.diff(np.concatenate([[0], quiet.astype(np.int8), [0]]))
+    starts = np.flatnonzero(edges == 1) * frame_seconds
+    ends = np.flatnonzero(edges == -1) * frame_seconds
+    keep = ends - starts >= min_silence
+    return list(zip(starts[keep].tolist(), ends[keep].tolist()))
+
+
+def write_speech(input_path, output_path, spans, max_seconds = None):
+    '''
+    Write only the spans (start, end) in seconds of the audio of a file to output_path in the upload encoding.
+    The audio is decoded, cut with NumPy and encoded block by block, so the upload is encoded only once.
+    '''
+    bounds = np.round(np.array(spans, dtype=float).reshape(-1, 2) * PCM_RATE).astype(np.int64)
+    encoder = (ffmpeg.input('pipe:', format='s16le', ac=1, ar=PCM_RATE).output(output_path, **AUDIO_OPTIONS)
+               .global_args('-loglevel', 'error').overwrite_output().run_async(pipe_stdin=True))
+    position = 0
+    try:
+        for samples in iter_pcm(input_path, max_seconds = max_seconds):
+            index = np.arange(position, position + len(samples))
+            span = np.maximum(np.searchsorted(bounds[:, 0], index, side='right') - 1, 0)
+            keep = (index >= bounds[span, 0]) & (index < bounds[span, 1])
+            encoder.stdin.write(samples[keep].tobytes())
+            position += len(samples)
+    finally:
+        encoder.stdin.close()
+        if encoder.wait() != 0:
+            raise ffmpeg.Error('ffmpeg', None, None)
+
+
+class OffsetMap:
+    '''
+    Map from the timeline of audio cut down to its speech spans back to the original timeline.
+    spans are the kept (start, end) of the original audio in seconds, in order.
+    '''
+    def __init__(self, spans):
+        spans = np.array(spans, dtype=float).reshape(-1, 2)
+        self.original_starts = spans[:, 0]
+        lengths = spans[:, 1] - spans[:, 0]
+        self.ends = np.cumsum(lengths)
+        self.starts = self.ends - lengths
+
+    def to_original(self, times, end = False):
+        '''
+        Original times of times [s] of the cut audio.
+        A time at the joint of two spans maps to the end of the first one if end, else to the start of the second.
+        '''
+        times = np.asarray(times, dtype=float)
+        if len(self.starts) == 0:
+            return times
+        if end:
+            span = np.searchsorted(self.ends, times, side='left')
+        else:
+            span = np.searchsorted(self.starts, times, side='right') - 1
+        span = np.clip(span, 0, len(self.starts) - 1)
+        return self.original_starts[span] + (times - self.starts[span])
+
+    def cut_silences(self, silences):
+        '''
+        Silences (start, end) of the original audio as silences of the cut audio, including the joints of the spans
+        '''
+        cut = [(joint, joint) for joint in self.ends[:-1].tolist()]
+        original_ends = self.original_starts + (self.ends - self.starts)
+        for start, end in silences:
+            span = np.searchsorted(self.original_starts, start, side='right') - 1
+            if span >= 0 and end <= original_ends[span]:
+                offset = self.starts[span] - self.original_starts[span]
+                cut.append((float(start + offset), float(end + offset)))
+        return sorted(cut)
+
+
+def prepare_chunks(input_path, audio_path, max_file_size = 24, max_seconds = None, metrics = None, vad = False,
+                   min_saving = 0.05, max_chunk_seconds = MAX_CHUNK_SECONDS):
+    '''
+    Extract the audio of input_path to audio_path and split it at silences under max_file_size [M]
+    and max_chunk_seconds.
+    With vad, the input is analysed first, and non-speech parts found by detect_speech are cut from the input
+    while it is encoded if that saves min_saving of the audio.
+    Return (paths of the chunks, offsets of the chunks [s], duration [s], speech spans), where the speech spans
+    (the argument of OffsetMap) are None if nothing was removed; offsets are then in the timeline of the cut audio.
+    The prefilter, the conversion and the split are stages of metrics (a metrics.RunMetrics) if given.
+    '''
+    speech_spans = None
+    if vad:
+        with stage(metrics, 'vad') as record:
+            energies = frame_energies(input_path, max_seconds = max_seconds)
+            duration = len(energies) * FRAME_SECONDS
+            spans = detect_speech(energies)
+            if spans and sum(end - start for start, end in spans) < (1.0 - min_saving) * duration:
+                speech_spans = spans
+                silences = OffsetMap(spans).cut_silences(find_silences(energies))
+            if record is not None:
+                record['bytes_in'] = os.path.getsize(input_path)
+    with stage(metrics, 'convert') as record:
+        if speech_spans is None:
+            silences = prepare_audio(input_path, audio_path, max_seconds = max_seconds)
+        else:
+            write_speech(input_path, audio_path, speech_spans, max_seconds = max_seconds)
+        if record is not None:
+            record['bytes_in'] = os.path.getsize(input_path)
+            record['bytes_out'] = os.path.getsize(audio_path)
+    cut_duration, file_size = probe(audio_path)
+    if speech_spans is None:
+        duration = cut_duration
+    chunks = plan_chunks(cut_duration, file_size, silences, max_file_size = max_file_size,
+                         max_chunk_seconds = max_chunk_seconds)
+    with stage(metrics, 'split', chunks=len(chunks)) as record:
+        file_paths = split_audio(audio_path, chunks)
+        if record is not None and len(file_paths) > 1:
+            record['bytes_in'] = os.path.getsize(audio_path)
+            record['bytes_out'] = sum(os.path.getsize(file_path) for file_path in file_paths)
+    return file_paths, [start for start, end in chunks], duration, speech_spans
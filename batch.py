@@ -0,0 +1,195 @@
+'''
+Headless batch processing of a directory of recordings.
+
+    python batch.py lectures/ --output-dir subtitles/ --jobs 4 --summary
+
+ffmpeg work runs in a process pool, API calls in threads of each job, and all jobs share the
+process-wide rate limiters of the API key.
+'''
+import argparse
+import glob
+import os
+import shutil
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+import artifacts
+import audio
+import cache
+import jobs
+import metrics
+import ratelimit
+import utils
+
+
+def process_file(input_path, output_dir, api_key, prompt, ffmpeg_pool, args, transcription_cache, translation_cache,
+                 run_metrics = None):
+    '''
+    Make the subtitles (and summary) of one recording in output_dir and return its statistics
+    '''
+    name = output_name(input_path, args.input_dir)
+    content_hash = cache.file_hash(input_path)
+    work_dir = os.path.join(args.work_dir, jobs.job_id(content_hash, name, prompt, args.test_mode,
+                                                       ','.join(args.languages), args.vad))
+    manifest = jobs.JobManifest(work_dir)
+    prepared = manifest.get_chunks()
+    if prepared is None:
+        audio_path = os.path.join(work_dir, 'audio' + audio.AUDIO_EXT)
+        # Conversion and split run in another process, so they are measured as one stage here
+        with metrics.stage(run_metrics, 'prepare', file=name) as record:
+            future = ffmpeg_pool.submit(audio.prepare_chunks, input_path, audio_path,
+                                        max_seconds = 120 if args.test_mode else None, vad = args.vad,
+                                        max_chunk_seconds = args.max_chunk_minutes * 60)
+            prepared = future.result()
+            if record is not None:
+                record['bytes_in'] = os.path.getsize(input_path)
+                record['bytes_out'] = sum(os.path.getsize(file_path) for file_path in prepared[0])
+        manifest.put_chunks(*prepared)
+    file_paths, offsets, duration, speech_spans = prepared
+
+    subtitle_files = artifacts.SubtitleArtifacts(name, ['ja'] + args.languages)
+    start_times = []
+    text_en = []
+    total_token = 0
+    errors = []
+    for event in utils.stream_subtitles(file_paths, offsets, api_key, prompt, max_workers = args.api_workers,
+                                        max_tokens = args.max_tokens,
+                                        transcription_cache = transcription_cache,
+                                        translation_cache = translation_cache,
+                                        manifest = manifest, metrics = run_metrics,
+                                        languages = args.languages,
+                                        offset_map = audio.OffsetMap(speech_spans) if speech_spans else None):
+        if 'chunk' in event:
+            if event['error'] is not None:
+                errors.append(f'chunk {event["chunk"]}: {event["error"]}')
+        else:
+            texts = {'ja': event['lines_ja']}
+            for language, translations in event['translations'].items():
+                texts[language] = [text for number, text in sorted(translations.items())]
+            subtitle_files.add_batch(event['start_times'], event['end_times'], texts)
+            start_times.extend(event['start_times'])
+            text_en.append(event['translations'].get('en', {}))
+            total_token += event['token']
+            for language, numbers in event['missing'].items():
+                if numbers:
+                    errors.append(f'{len(numbers)} lines not translated into {language}: {numbers}')
+
+    extra = {}
+    if args.summary:
+        lines_en = utils.text2list(text_en, start_times)
+        token, extra['_summary.txt'] = utils.get_summary(lines_en, api_key, summarize_ratio = args.summarize_ratio,
+                                                         cache = translation_cache, max_workers = args.api_workers,
+                                                         manifest = manifest, metrics = run_metrics)
+        total_token += token
+    subtitle_files.write(output_dir, extra)
+    # The work directory is kept for the next run if a chunk or line failed or an exception was raised
+    if not errors:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    return {'duration': duration, 'lines': len(start_times), 'token': total_token, 'errors': errors}
+
+
+def output_name(input_path, input_dir):
+    '''
+    Name of the output files of a recording; files in subdirectories are named after their relative path
+    '''
+    return os.path.splitext(os.path.relpath(input_path, input_dir))[0].replace(os.sep, '_')
+
+
+def find_inputs(input_dir):
+    paths = []
+    for ext in ('mp3', 'mp4'):
+        paths += glob.glob(os.path.join(input_dir, '**', '*.' + ext), recursive=True)
+    return sorted(paths)
+
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description='Generate Japanese and translated subtitles for a directory of MP3/MP4 files.')
+    parser.add_argument('input_dir')
+    parser.add_argument('--output-dir', default='output')
+    parser.add_argument('--api-key', default=os.environ.get('OPENAI_API_KEY', ''),
+                        help='OpenAI API key (default: $OPENAI_API_KEY)')
+    parser.add_argument('--terms0', default='')
+    parser.add_argument('--terms1', default='')
+    parser.add_argument('--talk-type', default='Lecture', choices=list(utils.TALK_TYPES))
+    parser.add_argument('--languages', nargs='+', default=['en'], choices=list(utils.LANGUAGES),
+                        help='target languages, translated concurrently from the same transcription')
+    parser.add_argument('--jobs', type=int, default=4, help='files processed at the same time')
+    parser.add_argument('--ffmpeg-workers', type=int, default=os.cpu_count() or 1, help='processes for ffmpeg')
+    parser.add_argument('--api-workers', type=int, default=4, help='concurrent API calls per file')
+    parser.add_argument('--max-tokens', type=int, default=1000, help='token budget of a translation batch')
+    parser.add_argument('--requests-per-minute', type=int, default=None, help='chat requests/min of the API key')
+    parser.add_argument('--tokens-per-minute', type=int, default=None, help='chat tokens/min of the API key')
+    parser.add_argument('--summary', action='store_true', help='also write an English summary')
+    parser.add_argument('--summarize-ratio', type=float, default=0.2)
+    parser.add_argument('--work-dir', default=jobs.JOBS_DIR,
+                        help='where unfinished jobs are kept; an interrupted run resumes from it')
+    parser.add_argument('--metrics', default=None,
+                        help='path prefix of the run report (.json) and Prometheus metrics (.prom); '
+                             'default: <output-dir>/metrics')
+    parser.add_argument('--max-chunk-minutes', type=float, default=audio.MAX_CHUNK_SECONDS / 60,
+                        help='longest audio chunk; chunks are transcribed concurrently')
+    parser.add_argument('--vad', action='store_true',
+                        help='remove long non-speech parts before upload; subtitle times stay on the original timeline')
+    parser.add_argument('--test-mode', action='store_true', help='only the first 120 seconds of each file')
+    args = parser.parse_args(argv)
+
+    if args.api_key == '':
+        parser.error('set --api-key or OPENAI_API_KEY')
+    if args.summary and 'en' not in args.languages:
+        parser.error('--summary needs en in --languages')
+    input_paths = find_inputs(args.input_dir)
+    if not input_paths:
+        parser.error(f'no MP3 or MP4 file in {args.input_dir}')
+    # Recordings whose output files would overwrite each other, e.g. lec.mp3 and lec.mp4
+    names = {}
+    for path in input_paths:
+        names.setdefault(output_name(path, args.input_dir), []).append(path)
+    collisions = [paths for paths in names.values() if len(paths) > 1]
+    if collisions:
+        parser.error('these files would write the same output files; rename them: ' +
+                     '; '.join(', '.join(paths) for paths in collisions))
+    os.makedirs(args.output_dir, exist_ok=True)
+    jobs.cleanup(args.work_dir)
+
+    # One limiter per endpoint is shared by all jobs of this process
+    ratelimit.get_rate_limiter(args.api_key, 'chat', args.requests_per_minute, args.tokens_per_minute)
+    prompt = utils.make_prompt(args.terms0, args.terms1, args.talk_type)
+    transcription_cache = cache.TranscriptionCache()
+    translation_cache = cache.CompletionCache()
+
+    run_metrics = metrics.RunMetrics()
+    start = time.time()
+    total_duration = 0.0
+    total_token = 0
+    failed = 0
+    with ProcessPoolExecutor(max_workers=args.ffmpeg_workers) as ffmpeg_pool, \
+         ThreadPoolExecutor(max_workers=args.jobs) as job_pool:
+        futures = {job_pool.submit(process_file, path, args.output_dir, args.api_key, prompt, ffmpeg_pool, args,
+                                   transcription_cache, translation_cache, run_metrics): path for path in input_paths}
+        for future in as_completed(futures):
+            path = futures[future]
+            try:
+                result = future.result()
+            except Exception as e:
+                failed += 1
+                print(f'FAILED {path}: {e}')
+                continue
+            total_duration += result['duration']
+            total_token += result['token']
+            print(f'done {path}: {result["duration"]/60:.1f} min, {result["lines"]} lines, {result["token"]} tokens')
+            for error in result['errors']:
+                print(f'  skipped {error}')
+
+    elapsed = time.time() - start
+    print(f'{len(input_paths) - failed}/{len(input_paths)} files, {total_duration/60:.1f} min of audio '
+          f'in {elapsed/60:.1f} min ({total_duration/max(elapsed, 1e-9):.1f}x real time), '
+          f'{len(input_paths)/max(elapsed, 1e-9)*3600:.1f} files/h, {total_token} tokens')
+    for total in run_metrics.summary():
+        print(f'  {total["stage"]:<12} {total["count"]:>5} runs {total["seconds"]:>9.1f} s '
+              f'(rate limit wait {total["rate_limit_wait"]:.1f} s) {total["tokens"]:>8} tokens')
+    prefix = args.metrics or os.path.join(args.output_dir, 'metrics')
+    run_metrics.write(prefix + '.json', prefix + '.prom')
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -0,0 +1,134 @@
+'''
+End-to-end benchmark of the utils pipeline against the local mock server (mock_openai.py).
+
+    python benchmark.py --minutes 10 60 300 --latency 0.2 --requests-per-minute 500 --error-rate 0.02
+
+For each synthetic recording length it runs get_transcribe, get_textlists, make_sentenses,
+get_translation, text2list and get_summary and reports wall time per stage, requests, tokens
+and the time spent waiting in the rate limiters. No real API request is made.
+'''
+import argparse
+import json
+import os
+import tempfile
+import time
+import audio
+import metrics
+import mock_openai
+import ratelimit
+import utils
+
+
+def make_chunks(audio_path, minutes, max_file_size = 24, max_chunk_seconds = audio.MAX_CHUNK_SECONDS):
+    '''
+    Write fake audio chunks of a recording of the given length; the mock server reads their size as duration.
+    Return the number of chunks and their offsets.
+    '''
+    duration = minutes * 60.0
+    file_size = duration * mock_openai.BYTES_PER_SECOND / 1e6
+    chunks = audio.plan_chunks(duration, file_size, [], max_file_size = max_file_size,
+                               max_chunk_seconds = max_chunk_seconds)
+    for file_path, (start, end) in zip(utils.chunk_paths(audio_path, len(chunks)), chunks):
+        with open(file_path, 'wb') as f:
+            f.write(b'\0' * int((end - start) * mock_openai.BYTES_PER_SECOND))
+    return len(chunks), [start for start, end in chunks]
+
+
+def run_case(minutes, mock, args):
+    '''
+    Run the pipeline on one synthetic recording and return its report
+    '''
+    audio_limiter = ratelimit.RateLimiter(args.client_requests_per_minute)
+    chat_limiter = ratelimit.RateLimiter(args.client_requests_per_minute, args.client_tokens_per_minute)
+    run_metrics = metrics.RunMetrics()
+    stats_before = dict(mock.stats)
+    stages = {}
+
+    with tempfile.TemporaryDirectory(prefix='bench_') as work_dir:
+        audio_path = os.path.join(work_dir, 'audio' + audio.AUDIO_EXT)
+        split_num, offsets = make_chunks(audio_path, minutes)
+        start = time.perf_counter()
+
+        t = time.perf_counter()
+        total_duration, response_list, errors = utils.get_transcribe(audio_path, split_num, args.api_key, 'prompt',
+                                                                     max_workers = args.workers,
+                                                                     rate_limiter = audio_limiter,
+                                                                     metrics = run_metrics)
+        stages['transcribe'] = time.perf_counter() - t
+
+        t = time.perf_counter()
+        texts, starts, ends = utils.get_textlists(response_list, offsets)
+        stages['textlists'] = time.perf_counter() - t
+
+        t = time.perf_counter()
+        start_times, end_times, lines_ja = utils.make_sentenses(starts, ends, texts)
+        stages['sentences'] = time.perf_counter() - t
+
+        t = time.perf_counter()
+        translation_token, text_en = utils.get_translation(lines_ja, args.api_key, chat_limiter,
+                                                           max_tokens = args.max_tokens, metrics = run_metrics)
+        stages['translation'] = time.perf_counter() - t
+
+        t = time.perf_counter()
+        lines_en = utils.text2list(text_en, start_times)
+        stages['text2list'] = time.perf_counter() - t
+
+        t = time.perf_counter()
+        summary_token, summary_en = utils.get_summary(lines_en, args.api_key, 0.2, rate_limiter = chat_limiter,
+                                                      max_workers = args.workers, metrics = run_metrics)
+        stages['summary'] = time.perf_counter() - t
+
+        wall = time.perf_counter() - start
+
+    stats = {name: mock.stats[name] - stats_before[name] for name in mock.stats}
+    return {'minutes': minutes, 'chunks': split_num, 'segments': len(texts), 'lines': len(lines_ja),
+            'failed_chunks': len(errors), 'wall': wall, 'stages': stages,
+            'requests': stats['transcriptions'] + stats['chat_completions'] + stats['rate_limited'],
+            'rate_limited': stats['rate_limited'], 'upload_bytes': stats['bytes'],
+            'tokens': translation_token + summary_token,
+            'rate_limit_wait': audio_limiter.wait_time + chat_limiter.wait_time,
+            'metrics': run_metrics.summary()}
+
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description='Benchmark the pipeline against a local mock OpenAI server.')
+    parser.add_argument('--minutes', type=float, nargs='+', default=[10, 60, 180, 300])
+    parser.add_argument('--latency', type=float, default=0.2, help='base reply delay of the mock [s]')
+    parser.add_argument('--latency-per-token', type=float, default=0.0)
+    parser.add_argument('--requests-per-minute', type=int, default=None, help='server-side limit of the mock')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='fraction of 429 replies injected by the mock')
+    parser.add_argument('--retry-after', type=float, default=0.5)
+    parser.add_argument('--client-requests-per-minute', type=int, default=3500, help='limit of the client limiters')
+    parser.add_argument('--client-tokens-per-minute', type=int, default=None)
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--max-tokens', type=int, default=1000)
+    parser.add_argument('--api-key', default='benchmark')
+    parser.add_argument('--json', help='also write the reports to this JSON file')
+    args = parser.parse_args(argv)
+
+    mock = mock_openai.MockOpenAI(args.latency, args.latency_per_token, args.requests_per_minute,
+                                  args.error_rate, args.retry_after)
+    server, base_url = mock_openai.start_server(mock)
+    os.environ['OPENAI_BASE_URL'] = base_url
+
+    reports = []
+    print(f'{"minutes":>8} {"chunks":>6} {"lines":>6} {"wall[s]":>8} {"transc":>7} {"transl":>7} {"summ":>7} '
+          f'{"local":>7} {"reqs":>5} {"429":>4} {"tokens":>8} {"wait[s]":>8}')
+    for minutes in args.minutes:
+        report = run_case(minutes, mock, args)
+        reports.append(report)
+        stages = report['stages']
+        local = stages['textlists'] + stages['sentences'] + stages['text2list']
+        print(f'{minutes:>8g} {report["chunks"]:>6} {report["lines"]:>6} {report["wall"]:>8.2f} '
+              f'{stages["transcribe"]:>7.2f} {stages["translation"]:>7.2f} {stages["summary"]:>7.2f} '
+              f'{local:>7.3f} {report["requests"]:>5} {report["rate_limited"]:>4} {report["tokens"]:>8} '
+              f'{report["rate_limit_wait"]:>8.2f}')
+    server.shutdown()
+
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(reports, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,235 @@
+import collections
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+import unicodedata
+
+
+def file_hash(file_path, block_size = 1 << 20):
+    '''
+    SHA-256 of the content of a file
+    '''
+    h = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+class TranscriptionCache:
+    '''
+    On-disk cache of transcription responses.
+    One JSON file per audio content hash, model, prompt and response_format.
+    The total size is capped at max_bytes by evicting the least recently used entries.
+    '''
+    def __init__(self, cache_dir = os.path.join('.cache', 'transcriptions'), max_bytes = 200 * 1024 * 1024):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def key(self, file_path, model, prompt, response_format):
+        h = hashlib.sha256()
+        for part in (file_hash(file_path), model, prompt, response_format):
+            h.update(part.encode('utf-8'))
+            h.update(b'\0')
+        return h.hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key + '.json')
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                response = json.load(f)
+        except (OSError, ValueError):
+            return None
+        # Mark as recently used
+        now = time.time()
+        try:
+            os.utime(path, (now, now))
+        except OSError:
+            pass
+        return response
+
+    def put(self, key, response):
+        path = self._path(key)
+        tmp_path = path + '.tmp' + str(threading.get_ident())
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(response, f, ensure_ascii=False)
+        os.replace(tmp_path, path)
+        self.evict()
+
+    def evict(self):
+        '''
+        Delete the least recently used entries until the total size is within max_bytes
+        '''
+        with self.lock:
+            entries = []
+            for name in os.listdir(self.cache_dir):
+                if not name.endswith('.json'):
+                    continue
+                try:
+                    stat = os.stat(os.path.join(self.cache_dir, name))
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, name))
+            total = sum(size for mtime, size, name in entries)
+            for mtime, size, name in sorted(entries):
+                if total <= self.max_bytes:
+                    break
+                try:
+                    os.remove(os.path.join(self.cache_dir, name))
+                except OSError:
+                    pass
+                total -= size
+
+
+def normalize_text(text):
+    '''
+    Normalize text for cache keys: NFKC and collapsed whitespace within each line
+    '''
+    return '\n'.join(' '.join(line.split()) for line in unicodedata.normalize('NFKC', text).split('\n'))
+
+
+class CompletionCache:
+    '''
+    SQLite cache of chat completions keyed by model, temperature, system message and normalized text.
+    Entries beyond max_entries are evicted in least recently used order, and entries not used for max_age
+    seconds are deleted, like the job directories of jobs.cleanup.
+    hits, misses and saved_tokens count the lookups of this instance.
+    '''
+    def __init__(self, db_path = os.path.join('.cache', 'completions.sqlite3'), max_entries = 100000,
+                 max_age = 7 * 24 * 3600):
+        self.max_entries = max_entries
+        self.max_age = max_age
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.saved_tokens = 0
+        if os.path.dirname(db_path):
+            os.makedirs(os.path.dirname(db_path), exist_ok=True)
+        self.connection = sqlite3.connect(db_path, timeout=30, check_same_thread=False)
+        with self.lock, self.connection:
+            self.connection.execute('PRAGMA journal_mode=WAL')
+            self.connection.execute('CREATE TABLE IF NOT EXISTS completions ('
+                                    'key TEXT PRIMARY KEY, content TEXT NOT NULL, '
+                                    'total_tokens INTEGER NOT NULL, last_used REAL NOT NULL)')
+            self.connection.execute('CREATE INDEX IF NOT EXISTS completions_last_used ON completions (last_used)')
+            self.connection.execute('DELETE FROM completions WHERE last_used < ?', (time.time() - max_age,))
+
+    def key(self, model, temperature, system, text):
+        h = hashlib.sha256()
+        for part in (model, repr(float(temperature)), system, normalize_text(text)):
+            h.update(part.encode('utf-8'))
+            h.update(b'\0')
+        return h.hexdigest()
+
+    def get(self, key):
+        '''
+        Return {'content', 'total_tokens'} of a stored completion, or None
+        '''
+        with self.lock, self.connection:
+            row = self.connection.execute('SELECT content, total_tokens FROM completions '
+                                          'WHERE key = ? AND last_used >= ?',
+                                          (key, time.time() - self.max_age)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.connection.execute('UPDATE completions SET last_used = ? WHERE key = ?', (time.time(), key))
+            self.hits += 1
+            self.saved_tokens += row[1]
+        return {'content': row[0], 'total_tokens': row[1]}
+
+    def put(self, key, content, total_tokens):
+        with self.lock, self.connection:
+            self.connection.execute('INSERT OR REPLACE INTO completions VALUES (?, ?, ?, ?)',
+                                    (key, content, total_tokens, time.time()))
+            self.connection.execute('DELETE FROM completions WHERE last_used < ?', (time.time() - self.max_age,))
+            count = self.connection.execute('SELECT COUNT(*) FROM completions').fetchone()[0]
+            if count > self.max_entries:
+                self.connection.execute('DELETE FROM completions WHERE key IN '
+                                        '(SELECT key FROM completions ORDER BY last_used LIMIT ?)',
+                                        (count - self.max_entries,))
+
+    def stats(self):
+        with self.lock:
+            entries = self.connection.execute('SELECT COUNT(*) FROM completions').fetchone()[0]
+            return {'hits': self.hits, 'misses': self.misses, 'saved_tokens': self.saved_tokens,
+                    'entries': entries}
+
+
+class CountedCompletionCache:
+    '''
+    CompletionCache of one job: the entries are those of cache, shared by all jobs,
+    while hits, misses and saved_tokens count only the lookups made through this object
+    '''
+    def __init__(self, cache):
+        self.cache = cache
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.saved_tokens = 0
+
+    def key(self, model, temperature, system, text):
+        return self.cache.key(model, temperature, system, text)
+
+    def get(self, key):
+        cached = self.cache.get(key)
+        with self.lock:
+            if cached is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self.saved_tokens += cached['total_tokens']
+        return cached
+
+    def put(self, key, content, total_tokens):
+        self.cache.put(key, content, total_tokens)
+
+    def stats(self):
+        entries = self.cache.stats()['entries']
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses, 'saved_tokens': self.saved_tokens,
+                    'entries': entries}
+
+
+class IdleCache:
+    '''
+    Process-wide objects made on first use of a key, e.g. per API key.
+    Entries not used for max_idle seconds, and the least recently used ones beyond max_entries,
+    are dropped and passed to close if given. Keys are stored as SHA-256 hashes, so secrets such as
+    API keys are not kept as keys.
+    '''
+    def __init__(self, max_idle = 3600, max_entries = 256, close = None):
+        self.max_idle = max_idle
+        self.max_entries = max_entries
+        self.close = close
+        self.lock = threading.Lock()
+        self.entries = collections.OrderedDict() # hashed key -> (object, last used), least recently used first
+
+    def get(self, key, make):
+        '''
+        Object of key (a tuple of strings), made by make() if there is none
+        '''
+        h = hashlib.sha256('\0'.join(str(part) for part in key).encode('utf-8')).hexdigest()
+        now = time.monotonic()
+        dropped = []
+        with self.lock:
+            entry = self.entries.pop(h, None)
+            obj = make() if entry is None else entry[0]
+            self.entries[h] = (obj, now)
+            while self.entries:
+                oldest, (old, used) = next(iter(self.entries.items()))
+                if now - used <= self.max_idle and len(self.entries) <= self.max_entries:
+                    break
+                del self.entries[oldest]
+                dropped.append(old)
+        if self.close is not None:
+            for old in dropped:
+                self.close(old)
+        return obj
@@ -0,0 +1,125 @@
+import os
+import uuid
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import cache
+import metrics
+import ratelimit
+
+
+# Set OPENAI_BASE_URL to send the requests to a local mock server
+DEFAULT_BASE_URL = 'https://api.openai.com/v1'
+
+
+class APIError(RuntimeError):
+    '''
+    Error reply of the API
+    '''
+    def __init__(self, status_code, message):
+        super().__init__(f'HTTP {status_code}: {message}')
+        self.status_code = status_code
+
+
+class MultipartFileStream:
+    '''
+    multipart/form-data body of fields and one file that is read from disk in blocks while it is sent.
+    The file is opened only during each iteration, so a retried request reads it again
+    and no handle is left open.
+    '''
+    def __init__(self, fields, file_field, file_path, block_size = 64 * 1024):
+        self.file_path = file_path
+        self.block_size = block_size
+        boundary = uuid.uuid4().hex
+        self.content_type = 'multipart/form-data; boundary=' + boundary
+
+        head = ''
+        for name, value in fields.items():
+            head += f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'
+        head += (f'--{boundary}\r\nContent-Disposition: form-data; name="{file_field}"; '
+                 f'filename="{os.path.basename(file_path)}"\r\n'
+                 'Content-Type: application/octet-stream\r\n\r\n')
+        self.head = head.encode('utf-8')
+        self.tail = f'\r\n--{boundary}--\r\n'.encode('utf-8')
+
+    def __len__(self):
+        return len(self.head) + os.path.getsize(self.file_path) + len(self.tail)
+
+    def __iter__(self):
+        yield self.head
+        with open(self.file_path, 'rb') as f:
+            for block in iter(lambda: f.read(self.block_size), b''):
+                yield block
+        yield self.tail
+
+
+class OpenAIClient:
+    '''
+    HTTP client of one API key with a pooled keep-alive session.
+    Failed connections are retried by urllib3; 429 and 5xx replies are retried under the rate limiter
+    by ratelimit.request_with_retry. Every request has a (connect, read) timeout.
+    '''
+    def __init__(self, api_key, base_url = None, timeout = (10, 600), max_retries = 5, pool_size = 16):
+        self.api_key = api_key
+        self.base_url = (base_url or os.environ.get('OPENAI_BASE_URL') or DEFAULT_BASE_URL).rstrip('/')
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.session = requests.Session()
+        self.session.headers['Authorization'] = f'Bearer {api_key}'
+        # Only failed connections are retried here; replies are handled by request_with_retry
+        retry = Retry(total=3, connect=3, read=0, status=0, backoff_factor=0.5, allowed_methods=None,
+                      respect_retry_after_header=False, raise_on_status=False)
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size, max_retries=retry)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def _request(self, send, rate_limiter, tokens):
+        response = ratelimit.request_with_retry(send, rate_limiter, tokens=tokens, max_retries=self.max_retries)
+        sent = response.request.body
+        metrics.add('bytes_in', len(sent) if sent is not None else 0)
+        metrics.add('bytes_out', len(response.content))
+        try:
+            body = response.json()
+        except ValueError:
+            raise APIError(response.status_code, response.text[:200])
+        if response.status_code != 200 or (isinstance(body, dict) and 'error' in body):
+            error = body.get('error') if isinstance(body, dict) else None
+            message = error.get('message', str(error)) if isinstance(error, dict) else response.text[:200]
+            raise APIError(response.status_code, message)
+        if isinstance(body, dict) and 'usage' in body:
+            metrics.add('tokens', body['usage'].get('total_tokens', 0))
+        return body
+
+    def post_json(self, path, payload, rate_limiter, tokens = 0):
+        '''
+        POST a JSON payload and return the JSON reply, or raise APIError
+        '''
+        url = self.base_url + path
+
+        def send():
+            return self.session.post(url, json=payload, timeout=self.timeout)
+        return self._request(send, rate_limiter, tokens)
+
+    def post_file(self, path, fields, file_path, rate_limiter, tokens = 0):
+        '''
+        POST fields and a file streamed from disk as multipart/form-data and return the JSON reply
+        '''
+        url = self.base_url + path
+        body = MultipartFileStream(fields, 'file', file_path)
+        headers = {'Content-Type': body.content_type}
+
+        def send():
+            return self.session.post(url, data=body, headers=headers, timeout=self.timeout)
+        return self._request(send, rate_limiter, tokens)
+
+
+# Clients of keys not used for an hour are dropped and their pooled connections closed
+_clients = cache.IdleCache(max_idle = 3600, max_entries = 256, close = lambda client: client.session.close())
+
+
+def get_client(api_key, base_url = None):
+    '''
+    Get the process-wide client of an API key and base URL so that connections are reused
+    '''
+    base_url = (base_url or os.environ.get('OPENAI_BASE_URL') or DEFAULT_BASE_URL).rstrip('/')
+    return _clients.get((api_key, base_url), lambda: OpenAIClient(api_key, base_url))
@@ -0,0 +1,120 @@
+import hashlib
+import json
+import os
+import shutil
+import threading
+import time
+
+
+JOBS_DIR = os.path.join('.cache', 'jobs')
+
+_work_dir_locks = {}
+_work_dir_locks_lock = threading.Lock()
+
+
+def job_id(content_hash, *settings):
+    '''
+    Id of a job from the hash of its input file and the settings that change its results
+    '''
+    h = hashlib.sha256(content_hash.encode('utf-8'))
+    for setting in settings:
+        h.update(b'\0')
+        h.update(str(setting).encode('utf-8'))
+    return h.hexdigest()[:16]
+
+
+def text_key(*parts):
+    '''
+    Short key of a unit of work from its inputs
+    '''
+    h = hashlib.sha256()
+    for part in parts:
+        h.update(part.encode('utf-8'))
+        h.update(b'\0')
+    return h.hexdigest()[:16]
+
+
+def work_dir_lock(work_dir):
+    '''
+    Process-wide lock of a work directory shared by several jobs, held while its files are written
+    '''
+    with _work_dir_locks_lock:
+        return _work_dir_locks.setdefault(os.path.abspath(work_dir), threading.Lock())
+
+
+class JobManifest:
+    '''
+    Durable record of the completed units of a job in work_dir/manifest.jsonl.
+    Each unit (stage, key) -> value is appended and fsynced as one JSON line as soon as it completes,
+    so a restarted job reads back every finished unit and resumes from the first incomplete one.
+    A line truncated by a crash is ignored.
+    '''
+    def __init__(self, work_dir):
+        self.work_dir = work_dir
+        self.path = os.path.join(work_dir, 'manifest.jsonl')
+        self.lock = threading.Lock()
+        self.records = {}
+        os.makedirs(work_dir, exist_ok=True)
+        if os.path.exists(self.path):
+            with open(self.path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue
+                    self.records[(record['stage'], record['key'])] = record['value']
+
+    def get(self, stage, key = ''):
+        with self.lock:
+            return self.records.get((stage, str(key)))
+
+    def put(self, stage, key, value):
+        line = json.dumps({'stage': stage, 'key': str(key), 'value': value}, ensure_ascii=False)
+        with self.lock:
+            with open(self.path, 'a', encoding='utf-8') as f:
+                f.write(line + '\n')
+                f.flush()
+                os.fsync(f.fileno())
+            self.records[(stage, str(key))] = value
+
+    def get_chunks(self):
+        '''
+        Recorded (paths of the chunks, offsets, duration, speech spans) of the prepared audio,
+        or None if any file is missing
+        '''
+        chunks = self.get('chunks')
+        if chunks is None:
+            return None
+        file_paths = [os.path.join(self.work_dir, name) for name in chunks['names']]
+        if not all(os.path.exists(file_path) for file_path in file_paths):
+            return None
+        return file_paths, chunks['offsets'], chunks['duration'], chunks.get('speech_spans')
+
+    def put_chunks(self, file_paths, offsets, duration, speech_spans = None):
+        '''
+        Record the prepared audio chunks, which must be in work_dir
+        '''
+        self.put('chunks', '', {'names': [os.path.basename(file_path) for file_path in file_paths],
+                                'offsets': offsets, 'duration': duration, 'speech_spans': speech_spans})
+
+    def count(self, stage):
+        with self.lock:
+            return sum(1 for record_stage, key in self.records if record_stage == stage)
+
+
+def cleanup(root = JOBS_DIR, max_age = 7 * 24 * 3600):
+    '''
+    Delete job directories not modified for max_age seconds
+    '''
+    if not os.path.isdir(root):
+        return
+    now = time.time()
+    for name in os.listdir(root):
+        path = os.path.join(root, name)
+        manifest_path = os.path.join(path, 'manifest.jsonl')
+        try:
+            modified = os.path.getmtime(manifest_path if os.path.exists(manifest_path) else path)
+        except OSError:
+            continue
+        if now - modified > max_age:
+            shutil.rmtree(path, ignore_errors=True)
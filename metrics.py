@@ -0,0 +1,109 @@
+import contextlib
+import contextvars
+import json
+import threading
+import time
+
+
+FIELDS = ('seconds', 'bytes_in', 'bytes_out', 'tokens', 'rate_limit_wait')
+
+# Record of the innermost stage running in the current thread or task
+_current = contextvars.ContextVar('metrics_stage', default=None)
+
+
+class RunMetrics:
+    '''
+    Per-stage measurements of one run of the pipeline.
+    Each stage records its duration, the bytes it read or uploaded (bytes_in), the bytes it wrote or
+    received (bytes_out), the API tokens it used and the seconds it waited for a rate limiter.
+    Code below a stage adds to it through add(), so the API client and the rate limiters need no handle.
+    '''
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.start = time.perf_counter()
+        self.records = []
+
+    @contextlib.contextmanager
+    def stage(self, name, **labels):
+        record = {'stage': name, **labels, **{field: 0 for field in FIELDS}}
+        token = _current.set(record)
+        start = time.perf_counter()
+        try:
+            yield record
+        finally:
+            record['seconds'] = time.perf_counter() - start
+            _current.reset(token)
+            with self.lock:
+                self.records.append(record)
+
+    def summary(self):
+        '''
+        Totals of each stage name in the order the stages first finished
+        '''
+        totals = {}
+        with self.lock:
+            for record in self.records:
+                total = totals.setdefault(record['stage'], {'stage': record['stage'], 'count': 0,
+                                                            **{field: 0 for field in FIELDS}})
+                total['count'] += 1
+                for field in FIELDS:
+                    total[field] += record[field]
+        return list(totals.values())
+
+    def report(self):
+        '''
+        JSON-serializable run report with the totals and every stage record
+        '''
+        with self.lock:
+            records = [dict(record) for record in self.records]
+        return {'started': self.started, 'wall': time.perf_counter() - self.start,
+                'stages': self.summary(), 'records': records}
+
+    def prometheus(self, prefix = 'subtitles'):
+        '''
+        Totals of each stage in the Prometheus text exposition format
+        '''
+        names = {'seconds': ('stage_seconds_total', 'Seconds spent in the stage.'),
+                 'count': ('stage_runs_total', 'Number of runs of the stage.'),
+                 'bytes_in': ('stage_bytes_in_total', 'Bytes read or uploaded by the stage.'),
+                 'bytes_out': ('stage_bytes_out_total', 'Bytes written or received by the stage.'),
+                 'tokens': ('stage_tokens_total', 'API tokens used by the stage.'),
+                 'rate_limit_wait': ('stage_rate_limit_wait_seconds_total', 'Seconds the stage waited for rate limits.')}
+        summary = self.summary()
+        lines = []
+        for field, (name, help_text) in names.items():
+            lines.append(f'# HELP {prefix}_{name} {help_text}')
+            lines.append(f'# TYPE {prefix}_{name} counter')
+            for total in summary:
+                lines.append(f'{prefix}_{name}{{stage="{total["stage"]}"}} {total[field]:g}')
+        lines.append(f'# HELP {prefix}_run_seconds Wall time of the run.')
+        lines.append(f'# TYPE {prefix}_run_seconds gauge')
+        lines.append(f'{prefix}_run_seconds {time.perf_counter() - self.start:g}')
+        return '\n'.join(lines) + '\n'
+
+    def write(self, json_path = None, prometheus_path = None):
+        if json_path is not None:
+            with open(json_path, 'w', encoding='utf-8') as f:
+                json.dump(self.report(), f, indent=2)
+        if prometheus_path is not None:
+            with open(prometheus_path, 'w', encoding='utf-8') as f:
+                f.write(self.prometheus())
+
+
+def stage(metrics, name, **labels):
+    '''
+    metrics.stage(name, **labels), or a stage that is not recorded if metrics is None
+    '''
+    if metrics is None:
+        return contextlib.nullcontext()
+    return metrics.stage(name, **labels)
+
+
+def add(field, value):
+    '''
+    Add value to a field of the current stage, if any
+    '''
+    record = _current.get()
+    if record is not None:
+        record[field] += value
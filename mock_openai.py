@@ -0,0 +1,171 @@
+'''
+Local stand-in for the OpenAI endpoints used by utils, for benchmarks without real requests.
+
+    python mock_openai.py --port 8000 --latency 0.5 --requests-per-minute 60 --error-rate 0.05
+    OPENAI_BASE_URL=http://127.0.0.1:8000/v1 streamlit run streamlit_app.py
+'''
+import argparse
+import email.parser
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import ratelimit
+import utils
+
+
+# Bytes per second of the upload encoding (24 kbps), used to turn a fake audio file into a duration
+BYTES_PER_SECOND = 3000
+
+
+def fake_segments(duration, segment_seconds = 4.0):
+    '''
+    Deterministic Japanese segments covering duration seconds; every third one ends a sentence
+    '''
+    segments = []
+    n = int(duration // segment_seconds)
+    for i in range(n):
+        text = f'これは{i}番目の区間の発言です' + ('。' if i % 3 == 2 else '、')
+        segments.append({'id': i, 'start': i * segment_seconds, 'end': (i + 1) * segment_seconds - 0.2,
+                         'text': text})
+    return segments
+
+
+class MockOpenAI:
+    '''
+    Behaviour and counters of the mock server.
+    latency is the base delay of a reply and latency_per_token the extra delay per completion token.
+    Requests over requests_per_minute, and a random error_rate of them, get 429 with Retry-After.
+    '''
+    def __init__(self, latency = 0.1, latency_per_token = 0.0, requests_per_minute = None, error_rate = 0.0,
+                 retry_after = 1.0, seed = 0):
+        self.latency = latency
+        self.latency_per_token = latency_per_token
+        self.limiter = None if requests_per_minute is None else ratelimit.RateLimiter(requests_per_minute)
+        self.error_rate = error_rate
+        self.retry_after = retry_after
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.stats = {'transcriptions': 0, 'chat_completions': 0, 'rate_limited': 0, 'tokens': 0, 'bytes': 0}
+
+    def count(self, name, value = 1):
+        with self.lock:
+            self.stats[name] += value
+
+    def rate_limited(self):
+        with self.lock:
+            injected = self.random.random() < self.error_rate
+        if injected:
+            return True
+        if self.limiter is None:
+            return False
+        # Reject instead of waiting when the bucket is empty
+        return not self.limiter.try_acquire()
+
+    def transcription(self, audio_bytes):
+        duration = len(audio_bytes) / BYTES_PER_SECOND
+        segments = fake_segments(duration)
+        reply = {'task': 'transcribe', 'language': 'japanese', 'duration': duration,
+                 'text': ''.join(segment['text'] for segment in segments), 'segments': segments}
+        return reply, 0
+
+    def chat_completion(self, payload):
+        messages = payload['messages']
+        user = messages[-1]['content']
+        if payload.get('response_format', {}).get('type') == 'json_object':
+            items = json.loads(user)
+            content = json.dumps({'translations': [{'id': item['id'], 'text': f'This is line {item["id"]}.'}
+                                                   for item in items]})
+        else:
+            words = user.split()
+            content = ' '.join(words[:max(1, len(words) // 5)])
+        prompt_tokens = sum(utils.estimate_tokens(message['content']) for message in messages)
+        completion_tokens = utils.estimate_tokens(content)
+        reply = {'object': 'chat.completion', 'model': payload.get('model'),
+                 'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': content},
+                              'finish_reason': 'stop'}],
+                 'usage': {'prompt_tokens': prompt_tokens, 'completion_tokens': completion_tokens,
+                           'total_tokens': prompt_tokens + completion_tokens}}
+        return reply, completion_tokens
+
+
+def make_handler(mock):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def reply(self, status, body, headers = None):
+            data = json.dumps(body).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            for name, value in (headers or {}).items():
+                self.send_header(name, value)
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            mock.count('bytes', len(body))
+            if mock.rate_limited():
+                mock.count('rate_limited')
+                self.reply(429, {'error': {'message': 'Rate limit reached', 'type': 'requests'}},
+                           {'Retry-After': str(mock.retry_after)})
+                return
+
+            if self.path.endswith('/audio/transcriptions'):
+                message = email.parser.BytesParser().parsebytes(
+                    b'Content-Type: ' + self.headers['Content-Type'].encode('latin-1') + b'\r\n\r\n' + body)
+                parts = {part.get_param('name', header='content-disposition'): part.get_payload(decode=True)
+                         for part in message.get_payload()}
+                reply, tokens = mock.transcription(parts.get('file', b''))
+                mock.count('transcriptions')
+            elif self.path.endswith('/chat/completions'):
+                reply, tokens = mock.chat_completion(json.loads(body))
+                mock.count('chat_completions')
+                mock.count('tokens', reply['usage']['total_tokens'])
+            else:
+                self.reply(404, {'error': {'message': f'Unknown path {self.path}'}})
+                return
+
+            time.sleep(mock.latency + mock.latency_per_token * tokens)
+            self.reply(200, reply)
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
+
+
+def start_server(mock, host = '127.0.0.1', port = 0):
+    '''
+    Start the mock server in a daemon thread and return (server, base URL)
+    '''
+    server = ThreadingHTTPServer((host, port), make_handler(mock))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f'http://{host}:{server.server_port}/v1'
+
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description='Mock OpenAI server for transcription and chat completion.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--latency', type=float, default=0.1, help='base delay of a reply [s]')
+    parser.add_argument('--latency-per-token', type=float, default=0.0, help='extra delay per completion token [s]')
+    parser.add_argument('--requests-per-minute', type=int, default=None)
+    parser.add_argument('--error-rate', type=float, default=0.0, help='fraction of requests answered with 429')
+    parser.add_argument('--retry-after', type=float, default=1.0)
+    args = parser.parse_args(argv)
+
+    mock = MockOpenAI(args.latency, args.latency_per_token, args.requests_per_minute, args.error_rate, args.retry_after)
+    server = ThreadingHTTPServer((args.host, args.port), make_handler(mock))
+    print(f'Serving on http://{args.host}:{server.server_port}/v1')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print(mock.stats)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,169 @@
+import random
+import threading
+import time
+from email.utils import parsedate_to_datetime
+import cache
+import metrics
+
+
+class RateLimiter:
+    '''
+    Token bucket limiter for requests/min and tokens/min.
+    Both buckets refill continuously, so requests are spread over the minute
+    instead of being sent in bursts followed by a long sleep.
+    '''
+    def __init__(self, requests_per_minute = 3, tokens_per_minute = None):
+        self.lock = threading.Lock()
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.request_bucket = float(requests_per_minute)
+        self.token_bucket = float(tokens_per_minute or 0)
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+        self.wait_time = 0.0 # total seconds callers slept in acquire()
+
+    def set_limits(self, requests_per_minute = None, tokens_per_minute = None):
+        with self.lock:
+            if requests_per_minute is not None:
+                self.requests_per_minute = requests_per_minute
+                self.request_bucket = min(self.request_bucket, requests_per_minute)
+            if tokens_per_minute is not None:
+                self.tokens_per_minute = tokens_per_minute
+                self.token_bucket = min(self.token_bucket, tokens_per_minute)
+
+    def _refill(self, now):
+        elapsed = now - self.updated
+        self.updated = now
+        self.request_bucket = min(self.requests_per_minute,
+                                  self.request_bucket + elapsed * self.requests_per_minute / 60.0)
+        if self.tokens_per_minute:
+            self.token_bucket = min(self.tokens_per_minute,
+                                    self.token_bucket + elapsed * self.tokens_per_minute / 60.0)
+
+    def _wait_needed(self, now, tokens):
+        wait = self.blocked_until - now
+        if self.request_bucket < 1.0:
+            wait = max(wait, (1.0 - self.request_bucket) * 60.0 / self.requests_per_minute)
+        if self.tokens_per_minute and self.token_bucket < tokens:
+            wait = max(wait, (tokens - self.token_bucket) * 60.0 / self.tokens_per_minute)
+        return wait
+
+    def acquire(self, tokens = 0):
+        '''
+        Block until one request with the estimated number of tokens may be sent
+        '''
+        if self.tokens_per_minute:
+            tokens = min(tokens, self.tokens_per_minute)
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self._refill(now)
+                wait = self._wait_needed(now, tokens)
+                if wait <= 0:
+                    self.request_bucket -= 1.0
+                    if self.tokens_per_minute:
+                        self.token_bucket -= tokens
+                    return
+                self.wait_time += wait
+            metrics.add('rate_limit_wait', wait)
+            time.sleep(wait)
+
+    def try_acquire(self, tokens = 0):
+        '''
+        Take one request without waiting; return False if it is not allowed now
+        '''
+        with self.lock:
+            now = time.monotonic()
+            self._refill(now)
+            if self._wait_needed(now, tokens) > 0:
+                return False
+            self.request_bucket -= 1.0
+            if self.tokens_per_minute:
+                self.token_bucket -= tokens
+            return True
+
+    def reconcile(self, estimated_tokens, used_tokens):
+        '''
+        Correct the token bucket once the real usage of a request is known
+        '''
+        if self.tokens_per_minute:
+            with self.lock:
+                self.token_bucket -= used_tokens - estimated_tokens
+
+    def pause(self, seconds):
+        '''
+        Hold back every caller for seconds, e.g. after a 429 reply
+        '''
+        with self.lock:
+            self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+
+# Default limits of each endpoint. The chat limit matches the free trial account.
+DEFAULT_LIMITS = {
+    'audio': {'requests_per_minute': 50, 'tokens_per_minute': None},
+    'chat': {'requests_per_minute': 3, 'tokens_per_minute': 40000},
+}
+
+# Limiters of keys not used for an hour are dropped; a key used again starts with full buckets
+_limiters = cache.IdleCache(max_idle = 3600, max_entries = 1024)
+
+
+def get_rate_limiter(api_key, endpoint = 'chat', requests_per_minute = None, tokens_per_minute = None):
+    '''
+    Get the process-wide limiter of an API key and endpoint ('audio' or 'chat').
+    Given limits replace the current ones.
+    '''
+    limiter = _limiters.get((api_key, endpoint), lambda: RateLimiter(**DEFAULT_LIMITS[endpoint]))
+    limiter.set_limits(requests_per_minute, tokens_per_minute)
+    return limiter
+
+
+def retry_after(response):
+    '''
+    Seconds to wait given by the Retry-After headers, or None
+    '''
+    value = response.headers.get('retry-after-ms')
+    if value is not None:
+        try:
+            return float(value) / 1000.0
+        except ValueError:
+            pass
+    value = response.headers.get('Retry-After')
+    if value is None:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def backoff(attempt, base_delay = 1.0, max_delay = 60.0):
+    '''
+    Exponential backoff with full jitter
+    '''
+    return random.uniform(0, min(max_delay, base_delay * 2 ** attempt))
+
+
+def request_with_retry(send, rate_limiter, tokens = 0, max_retries = 5):
+    '''
+    Call send() under rate_limiter and retry on 429 and 5xx replies.
+    The wait given by Retry-After (or a jittered backoff) pauses all callers of the limiter.
+    '''
+    for attempt in range(max_retries + 1):
+        rate_limiter.acquire(tokens)
+        response = send()
+        if response.status_code != 429 and response.status_code < 500:
+            return response
+        if attempt == max_retries:
+            return response
+        delay = retry_after(response)
+        if delay is None:
+            delay = backoff(attempt)
+        else:
+            delay += random.uniform(0, 1.0)
+        rate_limiter.pause(delay)
+    return response
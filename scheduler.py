@@ -0,0 +1,179 @@
+import collections
+import itertools
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+
+class Job:
+    '''
+    A job submitted to the Scheduler. Its functions report progress through update() and log(),
+    and the sessions that submitted it poll state, progress, messages, result and error.
+    '''
+    def __init__(self, job_id, api_key):
+        self.id = job_id
+        self.api_key = api_key
+        self.lock = threading.Lock()
+        self.state = 'waiting' # waiting -> preparing -> queued -> running -> done or failed
+        self.progress = {}
+        self.messages = []
+        self.result = None
+        self.error = None
+        self.submitted = time.time()
+        self.finished = None
+
+    def update(self, **progress):
+        with self.lock:
+            self.progress.update(progress)
+
+    def log(self, message):
+        with self.lock:
+            self.messages.append(message)
+
+    def snapshot(self):
+        with self.lock:
+            return {'state': self.state, 'progress': dict(self.progress), 'messages': list(self.messages),
+                    'error': self.error}
+
+    @property
+    def done(self):
+        return self.state in ('done', 'failed')
+
+
+class Scheduler:
+    '''
+    Process-wide scheduler of jobs shared by all sessions.
+    The ffmpeg part of every job runs in one pool of ffmpeg_workers threads, so conversions do not compete
+    for the CPU, and the API part runs in a fair FIFO queue of its API key that lets jobs_per_key jobs of
+    the key run at the same time. Jobs of different keys do not wait for each other, and the jobs of a key
+    share its process-wide rate limiters instead of tripping each other's limits.
+    '''
+    def __init__(self, ffmpeg_workers = os.cpu_count() or 1, jobs_per_key = 2, keep_seconds = 3600):
+        self.condition = threading.Condition()
+        self.ffmpeg_pool = ThreadPoolExecutor(max_workers=ffmpeg_workers, thread_name_prefix='ffmpeg')
+        self.jobs_per_key = jobs_per_key
+        self.keep_seconds = keep_seconds
+        self.jobs = {}
+        self.ffmpeg_waiting = collections.deque() # jobs submitted to the ffmpeg pool and not started yet
+        self.queues = collections.defaultdict(collections.deque) # API key -> jobs waiting for an API slot
+        self.active = collections.Counter() # API key -> number of running jobs
+        self.counter = itertools.count()
+
+    def submit(self, job_id, api_key, process, prepare = None):
+        '''
+        Run prepare(job) in the ffmpeg pool, if given, and then process(job, prepared) in the queue of api_key.
+        A job of the same id that has not finished is returned instead of starting another one.
+        '''
+        with self.condition:
+            self.prune()
+            job = self.jobs.get(job_id)
+            if job is not None and not job.done:
+                return job
+            job = Job(job_id, api_key)
+            self.jobs[job_id] = job
+            if prepare is None:
+                self.enqueue(job, process, None)
+            else:
+                self.ffmpeg_waiting.append(job)
+                self.ffmpeg_pool.submit(self.run_prepare, job, prepare, process)
+        return job
+
+    def get(self, job_id):
+        with self.condition:
+            return self.jobs.get(job_id)
+
+    def position(self, job):
+        '''
+        Number of jobs ahead of job in the ffmpeg pool or in the queue of its API key, or 0 if it is not waiting
+        '''
+        with self.condition:
+            if job.state == 'waiting':
+                return list(self.ffmpeg_waiting).index(job) if job in self.ffmpeg_waiting else 0
+            if job.state == 'queued':
+                queue = [waiting for waiting, process, prepared in self.queues.get(job.api_key, ())]
+                return queue.index(job) if job in queue else 0
+            return 0
+
+    def run_prepare(self, job, prepare, process):
+        with self.condition:
+            if job in self.ffmpeg_waiting:
+                self.ffmpeg_waiting.remove(job)
+            job.state = 'preparing'
+        try:
+            prepared = prepare(job)
+        except Exception as e:
+            self.finish(job, error=str(e))
+            return
+        with self.condition:
+            self.enqueue(job, process, prepared)
+
+    def enqueue(self, job, process, prepared):
+        # Called with the condition held
+        job.state = 'queued'
+        self.queues[job.api_key].append((job, process, prepared))
+        self.dispatch(job.api_key)
+
+    def dispatch(self, api_key):
+        # Called with the condition held: start the oldest jobs of the key while it has free slots
+        queue = self.queues[api_key]
+        while queue and self.active[api_key] < self.jobs_per_key:
+            job, process, prepared = queue.popleft()
+            self.active[api_key] += 1
+            job.state = 'running'
+            threading.Thread(target=self.run_process, args=(job, process, prepared), daemon=True,
+                             name=f'job-{next(self.counter)}').start()
+        if not queue:
+            del self.queues[api_key]
+
+    def run_process(self, job, process, prepared):
+        try:
+            result = process(job, prepared)
+        except Exception as e:
+            self.finish(job, error=str(e))
+        else:
+            self.finish(job, result=result)
+        finally:
+            with self.condition:
+                self.active[job.api_key] -= 1
+                if self.active[job.api_key] <= 0:
+                    del self.active[job.api_key]
+                if job.api_key in self.queues:
+                    self.dispatch(job.api_key)
+
+    def finish(self, job, result = None, error = None):
+        with self.condition:
+            job.result = result
+            job.error = error
+            job.state = 'failed' if error is not None else 'done'
+            job.finished = time.time()
+            self.condition.notify_all()
+
+    def wait(self, job, timeout = None):
+        '''
+        Block until job has finished or timeout seconds have passed, and return whether it has finished
+        '''
+        with self.condition:
+            return self.condition.wait_for(lambda: job.done, timeout)
+
+    def prune(self):
+        # Called with the condition held: forget jobs that finished keep_seconds ago
+        now = time.time()
+        for job_id in [job_id for job_id, job in self.jobs.items()
+                       if job.done and now - job.finished > self.keep_seconds]:
+            del self.jobs[job_id]
+
+
+_scheduler = None
+_scheduler_lock = threading.Lock()
+
+
+def get_scheduler(ffmpeg_workers = None, jobs_per_key = None):
+    '''
+    Get the process-wide scheduler; the arguments are used when it is created
+    '''
+    global _scheduler
+    with _scheduler_lock:
+        if _scheduler is None:
+            _scheduler = Scheduler(ffmpeg_workers or os.cpu_count() or 1, jobs_per_key or 2)
+        return _scheduler
@@ -1,16 +1,70 @@
 import streamlit as st
-import ffmpeg
-import zipfile
 import utils
+import ratelimit
+import cache
+import artifacts
+import audio
+import jobs
+import metrics
+import scheduler
 import os
-import tempfile
+import hashlib
+import time
 
 st.title('Translated subtitle generator')
 
+# Streamlit runs this script again on every widget change. The caches are opened once per server process,
+# and the results of a session are kept in st.session_state so that a rerun does not repeat paid requests.
+MAX_SESSION_RESULTS = 3 # results of different inputs or settings kept per session
+
+
+@st.cache_resource
+def get_caches():
+    # Transcriptions are kept across runs so that re-running the same audio is free
+    return cache.TranscriptionCache(), cache.CompletionCache()
+
+
+def upload_hash(uploaded_file):
+    '''
+    SHA-256 of an uploaded file, computed once per upload of the session
+    '''
+    # Streamlit 1.21 gives each upload an id; newer versions call it file_id
+    upload_key = (uploaded_file.name, uploaded_file.size,
+                  getattr(uploaded_file, 'id', None) or getattr(uploaded_file, 'file_id', None))
+    if st.session_state.get('upload_key') != upload_key:
+        uploaded_file.seek(0)
+        content_hash = hashlib.sha256()
+        for block in iter(lambda: uploaded_file.read(1024 * 1024), b''):
+            content_hash.update(block)
+        st.session_state['upload_key'] = upload_key
+        st.session_state['upload_hash'] = content_hash.hexdigest()
+    return st.session_state['upload_hash']
+
+
+def get_result(key):
+    return st.session_state.setdefault('results', {}).get(key)
+
+
+def put_result(key, result):
+    '''
+    Keep the result of key in the session and drop the oldest results.
+    Their work directories may be shared with other jobs and sessions, so they are left to jobs.cleanup.
+    '''
+    results = st.session_state.setdefault('results', {})
+    results.pop(key, None)
+    results[key] = result
+    while len(results) > MAX_SESSION_RESULTS:
+        results.pop(next(iter(results)))
+
+
+transcription_cache, translation_cache = get_caches()
+job_scheduler = scheduler.get_scheduler()
+rerun = getattr(st, 'rerun', None) or st.experimental_rerun
+
 
 markdown = ''' 
 **An application that uses OpenAI APIs to generate Japanese subtitles, 
-English subtitles and a summary from Japanese audio or video files.**
+English (and optionally Chinese and Korean) subtitles and a summary from Japanese audio or video files.**
 
 **About this application**
 
@@ -22,7 +76,7 @@ English subtitles and a summary from Japanese audio or video files.**
 
 - The data you upload will be sent to Open AI.
 - It will not be used to train models but may be viewed by Open AI. [Open AI Data policies](https://openai.com/policies/api-data-usage-policies)
-- This application does not retain any data after your session.
+- This application does not retain your uploaded files after your session. The converted audio and unfinished jobs are kept on the server for up to 7 days so that they can be resumed and reused while you change the settings. Transcriptions are cached on the server, keyed by the audio content, so that re-running the same audio is not charged again. Translations and summaries are also cached on the server, keyed by the text, for up to 7 days after their last use; a cached result is reused for any user who submits the same text.
 '''
 
 st.markdown(markdown)
@@ -40,20 +94,28 @@ st.markdown(markdown)
 terms0 = st.text_input('Terms0', '機械学習、数式、確率論、統計、微分、 データサイエンス', type="default")
 terms1 = st.text_input('Terms1', '根元事象、NumPy（ナムパイ）、Python（パイソン）、TensorFlow（テンサーフロー）、PyTorch（パイトーチ）', type="default")
 talk_type = st.selectbox('What kind of talk is your audio?',
-                         ('Lecture', 'Meeting', 'Conversation'))
+                         tuple(utils.TALK_TYPES))
 
-if talk_type == 'Lecture': ttype = '文の区切りは「。」です。準備は良いですか。それでは授業を開始します。'
-if talk_type == 'Meeting': ttype = '文の区切りは「。」です。準備は良いですか。それでは会議を開始します。'
-if talk_type == 'Conversation': ttype = '文の区切りは「。」です。ご機嫌いかがですか。それではお話ししましょう。' 
-prompt = '以下の内容を含みます：'+ terms0 + '、' + terms1 + '。\n ' + ttype
+prompt = utils.make_prompt(terms0, terms1, talk_type)
+
+# English is always made; the other languages are translated at the same time from the same transcription
+other_languages = [language for language in utils.LANGUAGES if language != 'en']
+extra_languages = st.multiselect('Other subtitle languages', other_languages,
+                                 format_func=lambda language: utils.LANGUAGES[language])
+languages = ['en'] + [language for language in other_languages if language in extra_languages]
 
 show_summary = st.checkbox('Check the box if you want an English summary')
 summarize_ratio = st.number_input('Summarization ratio from 0.1 to 1.0 (only valid if you check the above box.)', min_value=0.1, max_value=1.0, value=0.2)
 
+requests_per_minute = st.number_input('Chat requests per minute allowed for your API key (3 for free trial accounts)', min_value=1, value=3)
+tokens_per_minute = st.number_input('Chat tokens per minute allowed for your API key', min_value=1000, value=40000)
+
 uploaded_file = st.file_uploader("**Upload a MP3 or a MP4 file.**", type=["mp3", "mp4"])
 
 test_mode = st.checkbox('**Test mode:** check the box if you want to execute **only for the first 120 seconds.**')
 
+skip_silence = st.checkbox('Skip long silent parts (breaks, setup) before transcription to reduce the cost. Subtitle times are kept.')
+
 
 markdown = '''
 **Click the following Execute button** to generate transcriptions and translations,
@@ -63,121 +125,243 @@ and then **download a zip file.** It may take more than 5 minutes for 30 minutes
 st.markdown(markdown)
 execute = st.button('Execute')
 
-with tempfile.TemporaryDirectory(prefix="tmp_", dir=".") as dirpath:
-    print(dirpath)  # ./tmp_xo0tg2u1
-
-
-    if execute:
-        if api_key == '': 
-            st.write('Enter your API key')        
-        elif uploaded_file is None: 
-            st.write('Upload MP3 or MP4 file')
-        elif not (uploaded_file.name[-4:] in ['.mp3', '.mp4']):
-            st.write('Upload MP3 or MP4 file whose file name ends with .mp3 or .mp4') 
-
-        else:
-            file_name = uploaded_file.name
-
-            st.write('Preparing files...')
-            if file_name[-4:] == ".mp3":
-                    
-                # Set the path to the MP3 file
-                mp3_file_path = os.path.join(dirpath,  file_name)
-                with open(mp3_file_path,"wb") as f:
-                        f.write(uploaded_file.getvalue())
-                
-                # test mode
-                if test_mode:
-                    os.rename(mp3_file_path, mp3_file_path[:-4] + '_temp.mp3')
-                    stream = ffmpeg.input(mp3_file_path[:-4] + '_temp.mp3') 
-                    stream = ffmpeg.output(stream, mp3_file_path, t=120, ss=0)
-                    # 実行 
-                    ffmpeg.run(stream, overwrite_output=True) 
-
-            
-            if file_name[-4:] == ".mp4":
-                    
-                # Set the path to the MP4 file
-                mp4_file_path =  os.path.join(dirpath,  file_name)
-                with open(mp4_file_path,"wb") as f:
-                        f.write(uploaded_file.getvalue())
-
-
-                mp3_file_path = mp4_file_path[:-3] + "mp3"
-
-                # Convert MP4 to MP3
-                stream = ffmpeg.input(mp4_file_path) 
-                if test_mode: 
-                    stream = ffmpeg.output(stream, mp3_file_path, t=120, ss=0) 
-                else:
-                    stream = ffmpeg.output(stream, mp3_file_path)  
-                ffmpeg.run(stream, overwrite_output=True)
-            
-            
-            info = ffmpeg.probe(mp3_file_path)
-            duration = float(info['streams'][0]['duration']) # unit [s]
-            file_size = float(info['format']['size'])/1e6 # unit [M]
-            
-            # split the MP3 file with overlaps if its size is more than 24 [M]
-            max_file_size = 24  #Default 24
-            split_num = int(file_size//max_file_size) + 1
-            each_duration = duration/split_num  
-            print(each_duration)
-            overlap = 20.0
-
-            if split_num > 1:
-                for i in range(split_num):
-                    stream = ffmpeg.input(mp3_file_path) 
-                    # 出力 
-                    stream = ffmpeg.output(stream, mp3_file_path[:-4] + str(i) + '.mp3', t=each_duration + overlap, ss= each_duration * i)
-                    # 実行 
-                    ffmpeg.run(stream, overwrite_output=True) #[M]
-            
-            st.write('Transcribing ...')
-            total_duration, response_list = utils.get_transcribe(mp3_file_path, split_num, api_key, prompt)
-            st.write('Transcription completed. The total duration was', '{:.1f}'.format(total_duration/60) , 'min. The cost was about $', '{:.3f}'.format(total_duration /60 * 0.006))
-
-            texts, starts, ends = utils.get_textlists(response_list, split_num, each_duration)
-            start_times, end_times, lines_ja = utils.make_sentenses(starts, ends, texts)
-
-            st.write(lines_ja)
-            st.write('Translating ...')
-            total_token, text_en = utils.get_translation(lines_ja, api_key)
-            st.write('Translation completed. The number of token was ', total_token, ' tokens. The cost was about $', '{:.3f}'.format(total_token * 0.002 / 1000))
-            lines_en = utils.text2list(text_en, start_times)
-
-            ja_srt_data = utils.make_srt(start_times, end_times, lines_ja, mp3_file_path, language='ja') 
-            ja_csv_data = utils.make_csv(start_times, end_times, lines_ja, mp3_file_path, language='ja')
-            en_srt_data = utils.make_srt(start_times, end_times, lines_en, mp3_file_path, language='en') 
-            en_csv_data = utils.make_csv(start_times, end_times, lines_en, mp3_file_path, language='en')
-
-            if show_summary:
-                st.write('Summarizing ...')
-                total_token, summary_en = utils.get_summary(lines_en, api_key, summarize_ratio = summarize_ratio)
-                st.write('Summarization completed. The cost was about $', '{:.3f}'.format(total_token * 0.002 / 1000))
-                output_file_path = mp3_file_path[:-4] + '_summary.txt'
-
-                with open(output_file_path, 'w', encoding='utf-8') as f:
-                    f.write(summary_en)
-                f.close()
-            
-            zip_file_path = mp3_file_path[:-4] + '.zip'
-            with zipfile.ZipFile(zip_file_path, 'w') as zip:
-                arcname = os.path.basename(zip_file_path)[:-4]
-                zip.write(mp3_file_path[:-4] + '_ja.srt', arcname + '_ja.srt')
-                zip.write(mp3_file_path[:-4] + '_ja.csv', arcname + '_ja.csv')
-                zip.write(mp3_file_path[:-4] + '_en.srt', arcname + '_en.srt')
-                zip.write(mp3_file_path[:-4] + '_en.csv', arcname + '_en.csv')
-                if show_summary:
-                    zip.write(mp3_file_path[:-4] + '_summary.txt', arcname + '_summary.txt')        
-            zip.close()
-            
-
-            with open(zip_file_path, "rb") as file:
-                btn = st.download_button(
-                    label = "Download created files",
-                    data = file,
-                    file_name = os.path.basename(zip_file_path),
-                    mime= "application/zip"
-                )
-                
+if execute:
+    if api_key == '': 
+        st.write('Enter your API key')        
+    elif uploaded_file is None: 
+        st.write('Upload MP3 or MP4 file')
+    elif not (uploaded_file.name[-4:] in ['.mp3', '.mp4']):
+        st.write('Upload MP3 or MP4 file whose file name ends with .mp3 or .mp4') 
+
+    else:
+        file_name = uploaded_file.name
+        content_hash = upload_hash(uploaded_file)
+        result_key = jobs.job_id(content_hash, file_name, prompt, test_mode, ','.join(languages), skip_silence)
+        result = get_result(result_key)
+        ratelimit.get_rate_limiter(api_key, 'chat', requests_per_minute, tokens_per_minute)
+
+        # Jobs of other API keys are never shared
+        scheduler_id = jobs.job_id(result_key, api_key)
+        running = job_scheduler.get(scheduler_id)
+        if running is not None and not running.done:
+            # Already running, e.g. submitted before the page was reloaded
+            st.session_state.setdefault('pending_jobs', {})[running.id] = result_key
+
+        # Subtitles are made again only for a new input or prompt, or to retry failed chunks and lines
+        elif result is None or result['failed_chunks'] > 0 or result['missing_lines'] > 0:
+            jobs.cleanup()
+            # Durable work directories, so that a failed job can be resumed: the converted audio depends
+            # only on the input and is shared by all jobs of the input, and the transcriptions and translations
+            # also depend on the prompt and the API key
+            audio_dir = os.path.join(jobs.JOBS_DIR, jobs.job_id(content_hash, file_name, test_mode, skip_silence))
+            job_dir = os.path.join(jobs.JOBS_DIR, scheduler_id)
+            manifest = jobs.JobManifest(job_dir)
+            run_metrics = metrics.RunMetrics()
+            with_summary = show_summary
+            ratio = summarize_ratio
+
+            input_file_path = None
+            if jobs.JobManifest(audio_dir).get_chunks() is None:
+                # The upload is copied here, in blocks instead of another full copy with getvalue(),
+                # and converted later in the ffmpeg pool of the scheduler. Each job has its own copy,
+                # so that no job overwrites the input another job is converting.
+                input_file_path = os.path.join(audio_dir, f'input-{scheduler_id}{file_name[-4:]}')
+                uploaded_file.seek(0)
+                with open(input_file_path,"wb") as f:
+                    for block in iter(lambda: uploaded_file.read(1024 * 1024), b''):
+                        f.write(block)
+
+            def prepare(job):
+                try:
+                    # One conversion per audio directory at a time; a job that waited for another one
+                    # reads the chunks it recorded instead of converting the input again
+                    with jobs.work_dir_lock(audio_dir):
+                        audio_manifest = jobs.JobManifest(audio_dir)
+                        prepared = audio_manifest.get_chunks()
+                        if prepared is None and input_file_path is not None:
+                            job.log('Preparing files...')
+                            # Extract compact mono audio and detect silences in one pass (only the first 120 s in test mode)
+                            # split the audio file at silences if its size is more than 24 [M] or it is longer than 10 min,
+                            # so that the chunks are transcribed concurrently and the first subtitles come early
+                            max_file_size = 24  #Default 24
+                            max_chunk_seconds = 600
+                            # A fixed name, since the split template of the segment muxer must not contain the user's file name
+                            audio_file_path = os.path.join(audio_dir, 'audio' + audio.AUDIO_EXT)
+                            prepared = audio.prepare_chunks(input_file_path, audio_file_path, max_file_size = max_file_size,
+                                                            max_seconds = 120 if test_mode else None, metrics = run_metrics,
+                                                            vad = skip_silence, max_chunk_seconds = max_chunk_seconds)
+                            audio_manifest.put_chunks(*prepared)
+                finally:
+                    if input_file_path is not None and os.path.exists(input_file_path):
+                        os.remove(input_file_path)
+                if prepared is None:
+                    raise RuntimeError('The converted audio was deleted before it was used.')
+                return prepared
+
+            def process(job, prepared):
+                if manifest.count('transcription') or manifest.count('translation'):
+                    job.log(f'Resuming the previous job: {manifest.count("transcription")} transcribed chunks and '
+                            f'{manifest.count("translation")} translated batches are reused.')
+                file_paths, offsets, duration, speech_spans = prepared
+                if speech_spans:
+                    speech = sum(end - start for start, end in speech_spans)
+                    job.log(f'Silent parts were skipped: {speech/60:.1f} of {duration/60:.1f} min are transcribed.')
+
+                job.log('Transcribing and translating ...')
+                total_duration = 0.0
+                total_token = 0
+                start_times = []
+                text_en = []
+                failed_chunks = 0
+                missing_lines = 0
+                # Subtitle files grow batch by batch, and what is done so far can be downloaded at any time
+                subtitle_files = artifacts.SubtitleArtifacts(file_name[:-4], ['ja'] + languages)
+                # Cache hits of this job only, while the entries are shared by all sessions
+                job_cache = cache.CountedCompletionCache(translation_cache)
+                job.update(chunks = 0, total_chunks = len(file_paths), lines = 0, files = subtitle_files)
+                for event in utils.stream_subtitles(file_paths, offsets, api_key, prompt, max_workers = 4, max_tokens = 1000,
+                                                  transcription_cache = transcription_cache,
+                                                  translation_cache = job_cache,
+                                                  manifest = manifest, metrics = run_metrics,
+                                                  languages = languages,
+                                                  offset_map = audio.OffsetMap(speech_spans) if speech_spans else None):
+                    if 'chunk' in event:
+                        total_duration += event['duration']
+                        if event['error'] is not None:
+                            failed_chunks += 1
+                            job.log(f'Transcription of chunk {event["chunk"]} failed and was skipped: {event["error"]}')
+                        job.update(chunks = event['chunk'] + 1)
+                    else:
+                        texts = {'ja': event['lines_ja']}
+                        for language, translations in event['translations'].items():
+                            texts[language] = [text for number, text in sorted(translations.items())]
+                        subtitle_files.add_batch(event['start_times'], event['end_times'], texts)
+                        latest = list(texts.values())
+                        start_times.extend(event['start_times'])
+                        text_en.append(event['translations']['en'])
+                        total_token += event['token']
+                        for language, numbers in event['missing'].items():
+                            if numbers:
+                                missing_lines += len(numbers)
+                                job.log(f'{len(numbers)} lines were not translated into {utils.LANGUAGES[language]} '
+                                        f'and were left empty: {numbers}')
+                        job.update(lines = len(start_times), latest = latest)
+
+                result = {'file_name': file_name, 'duration': total_duration, 'token': total_token,
+                          'files': subtitle_files, 'lines_en': utils.text2list(text_en, start_times),
+                          'failed_chunks': failed_chunks, 'missing_lines': missing_lines,
+                          'cache_stats': job_cache.stats(), 'metrics': run_metrics,
+                          'summaries': {}, 'zips': {}}
+                if with_summary:
+                    job.log('Summarizing ...')
+                    result['summaries'][ratio] = utils.get_summary(result['lines_en'], api_key, summarize_ratio = ratio,
+                                                                   cache = job_cache, manifest = manifest,
+                                                                   metrics = run_metrics)
+                return result
+
+            job = job_scheduler.submit(scheduler_id, api_key, process, prepare)
+            st.session_state.setdefault('pending_jobs', {})[job.id] = result_key
+
+        # A summary is made only for a ratio that has not been summarized yet
+        elif show_summary and summarize_ratio not in result['summaries']:
+            ratio = summarize_ratio
+            # Partial summaries are checkpointed in the work directory of the job that made the subtitles
+            manifest = jobs.JobManifest(os.path.join(jobs.JOBS_DIR, scheduler_id))
+
+            def summarize(job, prepared):
+                job.log('Summarizing ...')
+                result['summaries'][ratio] = utils.get_summary(result['lines_en'], api_key, summarize_ratio = ratio,
+                                                               cache = translation_cache, manifest = manifest,
+                                                               metrics = result['metrics'])
+
+            job = job_scheduler.submit(f'{scheduler_id}:summary:{ratio}', api_key, summarize)
+            st.session_state.setdefault('pending_jobs', {})[job.id] = None
+
+
+# Jobs of this session run in the scheduler shared by all sessions; the page polls them until they finish
+pending_jobs = st.session_state.setdefault('pending_jobs', {})
+partial_zips = st.session_state.setdefault('partial_zips', {}) # job id -> (lines, zip of the files so far)
+for job_id, result_key in list(pending_jobs.items()):
+    job = job_scheduler.get(job_id)
+    if job is None:
+        del pending_jobs[job_id]
+        continue
+    snapshot = job.snapshot()
+    for message in snapshot['messages']:
+        st.write(message)
+    progress = snapshot['progress']
+    if snapshot['state'] == 'waiting':
+        st.write('Waiting for audio conversion: ', job_scheduler.position(job), ' jobs ahead.')
+    elif snapshot['state'] == 'queued':
+        st.write('Waiting for the API: ', job_scheduler.position(job), ' jobs of the same API key ahead.')
+    elif 'total_chunks' in progress and not job.done:
+        st.write('Transcribed ', progress['chunks'], ' of ', progress['total_chunks'], ' chunks and translated ',
+                 progress['lines'], ' lines.')
+        for lines in progress.get('latest', []):
+            st.write(lines)
+        if progress['lines'] > 0:
+            # The zip is made again only when new lines were added, not on every poll
+            if partial_zips.get(job_id, (None,))[0] != progress['lines']:
+                partial_zips[job_id] = (progress['lines'], progress['files'].zip_bytes())
+            st.download_button(
+                label = f'Download the {progress["lines"]} lines made so far',
+                data = partial_zips[job_id][1],
+                file_name = progress['files'].name + '_partial.zip',
+                mime = "application/zip")
+    if job.done:
+        del pending_jobs[job_id]
+        partial_zips.pop(job_id, None)
+        if snapshot['error'] is not None:
+            st.write('The job failed: ', snapshot['error'], ' Execute again to resume it.')
+        elif result_key is not None:
+            put_result(result_key, job.result)
+
+if pending_jobs:
+    time.sleep(1)
+    rerun()
+
+
+# Results of the current input and settings are shown on every rerun, e.g. after the download button is clicked
+result = None
+if uploaded_file is not None:
+    result = get_result(jobs.job_id(upload_hash(uploaded_file), uploaded_file.name, prompt, test_mode,
+                                    ','.join(languages), skip_silence))
+
+if result is not None:
+    st.write('Transcription completed. The total duration was', '{:.1f}'.format(result['duration']/60) , 'min. The cost was about $', '{:.3f}'.format(result['duration'] /60 * 0.006))
+    st.write('Translation completed. The number of token was ', result['token'], ' tokens. The cost was about $', '{:.3f}'.format(result['token'] * 0.002 / 1000))
+    stats = result['cache_stats']
+    st.write('Translation cache: ', stats['hits'], ' hits, ', stats['misses'], ' misses, ', stats['saved_tokens'], ' tokens saved.')
+    if result['failed_chunks'] > 0:
+        st.write('Execute again with the same file to retry the failed chunks.')
+    if result['missing_lines'] > 0:
+        st.write(result['missing_lines'], ' translated lines are empty. Execute again with the same file to retry them.')
+
+    summary = result['summaries'].get(summarize_ratio) if show_summary else None
+    if summary is not None:
+        st.write('Summarization completed. The cost was about $', '{:.3f}'.format(summary[0] * 0.002 / 1000))
+    elif show_summary:
+        st.write('Click Execute to make the summary. The subtitles are not made again.')
+
+    # Where the time went: totals of each stage of this run
+    run_metrics = result['metrics']
+    with st.expander('Timing breakdown'):
+        st.table([{'stage': total['stage'], 'runs': total['count'], 'seconds': round(total['seconds'], 2),
+                   'rate limit wait [s]': round(total['rate_limit_wait'], 2), 'tokens': total['tokens'],
+                   'MB in': round(total['bytes_in'] / 1e6, 2), 'MB out': round(total['bytes_out'] / 1e6, 2)}
+                  for total in run_metrics.summary()])
+        st.json(run_metrics.report(), expanded=False)
+        st.code(run_metrics.prometheus())
+
+    # The zip of each summary choice is made once in memory and kept in the session
+    zip_key = summarize_ratio if summary is not None else None
+    if zip_key not in result['zips']:
+        extra = {'_summary.txt': summary[1]} if summary is not None else None
+        result['zips'][zip_key] = result['files'].zip_bytes(extra)
+
+    btn = st.download_button(
+        label = "Download created files",
+        data = result['zips'][zip_key],
+        file_name = result['file_name'][:-4] + '.zip',
+        mime= "application/zip"
+    )
@@ -1,17 +1,54 @@
-import requests
-import csv
-import re
-import time
-import streamlit as st
+import json
+import os
+import numpy as np
+import artifacts
+import ratelimit
+import client
+import jobs
+from concurrent.futures import ThreadPoolExecutor
+from metrics import stage
 
 
-def transcribe(file_path, output_format, api_key, prompt):
+WHISPER_MODEL = 'whisper-1'
+CHAT_MODEL = 'gpt-3.5-turbo'
+CHAT_TEMPERATURE = 0
+
+# Target languages of translation: code -> name used in the prompt
+LANGUAGES = {'en': 'English', 'zh': 'Simplified Chinese', 'ko': 'Korean'}
+
+
+def translation_system(language = 'en'):
+    '''
+    System message of the JSON translation into a language of LANGUAGES
+    '''
+    name = LANGUAGES[language]
+    return ('The user message is a JSON array of Japanese lines as {"id": number, "text": Japanese}. '
+            f'Translate each line in brief {name}. ' + ('Use we for the first person. ' if language == 'en' else '') +
+            'Reply only with a JSON object {"translations": [{"id": number, "text": ' + name + '}, ...]} '
+            'that has exactly one item for each id.\n')
+
+
+TALK_TYPES = {
+    'Lecture': '文の区切りは「。」です。準備は良いですか。それでは授業を開始します。',
+    'Meeting': '文の区切りは「。」です。準備は良いですか。それでは会議を開始します。',
+    'Conversation': '文の区切りは「。」です。ご機嫌いかがですか。それではお話ししましょう。',
+}
+
+
+def make_prompt(terms0, terms1, talk_type = 'Lecture'):
     '''
-    Request form of transcription
+    Prompt of transcription from technical terms and the kind of talk
+    '''
+    return '以下の内容を含みます：'+ terms0 + '、' + terms1 + '。\n ' + TALK_TYPES[talk_type]
+
+
+def transcribe(file_path, output_format, api_key, prompt, rate_limiter = None):
     '''
-    url = 'https://api.openai.com/v1/audio/transcriptions'
-    headers = {'Authorization': f'Bearer {api_key}'}
-    file = {'file': open(file_path, 'rb')}
+    Request form of transcription and return the JSON reply.
+    Raise client.APIError if the API returns an error.
+    '''
+    if rate_limiter is None:
+        rate_limiter = ratelimit.get_rate_limiter(api_key, 'audio')
     data = {
         # "fileType": 'mp3', #default is wav
         # "diarization": "false",
@@ -22,31 +59,94 @@ def transcribe(file_path, output_format, api_key, prompt):
         #if no value set, the model figures out numSpeakers automatically!
         # "url": "URL_OF_STORED_AUDIO_FILE", #can't have both a url and file sent!
         # "language": "ja", #if this isn't set, the model will auto detect language,
-        'model': 'whisper-1',
+        'model': WHISPER_MODEL,
         'response_format': output_format,
         'prompt': prompt
     }
-    response = requests.post(url, headers=headers, files=file, data=data)
-    return response
+
+    return client.get_client(api_key).post_file('/audio/transcriptions', data, file_path, rate_limiter)
 
 
-def get_transcribe(mp3_file_path, split_num, api_key, prompt):
+def transcribe_chunk(file_path, api_key, prompt, rate_limiter = None, cache = None):
+    '''
+    Transcribe one file and return the verbose_json response.
+    Raise client.APIError if the API returns an error.
+    The response is read from and stored to cache (a cache.TranscriptionCache) if given.
     '''
-    Get response of transcription
+    if cache is not None:
+        key = cache.key(file_path, WHISPER_MODEL, prompt, 'verbose_json')
+        body = cache.get(key)
+        if body is not None:
+            return body
+
+    body = transcribe(file_path, 'verbose_json', api_key, prompt, rate_limiter)
+    if cache is not None:
+        cache.put(key, body)
+    return body
+
+
+def chunk_paths(mp3_file_path, split_num):
+    '''
+    Paths of the split tracks <name>N<ext>, or the file itself if it is not split
     '''
-    total_duration = 0.0
     if split_num == 1:
-        response = transcribe(mp3_file_path, 'verbose_json', api_key, prompt).json()
-        response_list = [response]
-        total_duration = response['duration']
+        return [mp3_file_path]
+    base, ext = os.path.splitext(mp3_file_path)
+    return [base + str(i) + ext for i in range(split_num)]
 
-    else:
-        response_list = []
-        for i in range(split_num):
-            response = transcribe(mp3_file_path[:-4] + str(i) + '.mp3', 'verbose_json', api_key, prompt).json()
-            response_list.append(response)
-            total_duration += response['duration']
-    return total_duration, response_list
+
+def iter_transcribe(file_paths, api_key, prompt, max_workers = 4, rate_limiter = None, cache = None, manifest = None,
+                    metrics = None):
+    '''
+    Transcribe files concurrently and yield (index, response, error) in file order
+    as soon as each response and all the previous ones are ready.
+    A failed file gives an empty response and its error message.
+    Responses recorded in manifest (a jobs.JobManifest) are reused, and new ones are recorded.
+    Each transcription is a stage of metrics (a metrics.RunMetrics) if given.
+    '''
+    def transcribe_and_record(i, file_path):
+        with stage(metrics, 'transcription', chunk=i):
+            response = transcribe_chunk(file_path, api_key, prompt, rate_limiter, cache)
+        if manifest is not None:
+            manifest.put('transcription', i, response)
+        return response
+
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(file_paths)))) as executor:
+        futures = []
+        for i, file_path in enumerate(file_paths):
+            response = None if manifest is None else manifest.get('transcription', i)
+            if response is None:
+                futures.append(executor.submit(transcribe_and_record, i, file_path))
+            else:
+                futures.append(response)
+        for i, future in enumerate(futures):
+            if isinstance(future, dict):
+                yield i, future, None
+                continue
+            try:
+                yield i, future.result(), None
+            except Exception as e:
+                yield i, {'duration': 0.0, 'segments': []}, str(e)
+
+
+def get_transcribe(mp3_file_path, split_num, api_key, prompt, max_workers = 4, rate_limiter = None, cache = None,
+                   metrics = None):
+    '''
+    Get response of transcription.
+    Split chunks are transcribed concurrently by max_workers threads and the responses
+    are returned in chunk order. A failed chunk is replaced by an empty response and its
+    error message is returned in errors as {chunk index: message}.
+    '''
+    response_list = []
+    errors = {}
+    for i, response, error in iter_transcribe(chunk_paths(mp3_file_path, split_num), api_key, prompt,
+                                              max_workers, rate_limiter, cache, metrics = metrics):
+        response_list.append(response)
+        if error is not None:
+            errors[i] = error
+
+    total_duration = sum(response['duration'] for response in response_list)
+    return total_duration, response_list, errors
 
 
 def seconds2SRT(time, start_time = 0.0): # time in seconds
@@ -61,282 +161,499 @@ def seconds2SRT(time, start_time = 0.0): # time in seconds
     return f'{hours.zfill(2)}:{minutes.zfill(2)}:{seconds.zfill(2)},{miliseconds.zfill(3)}'
 
 
-def get_textlists(response_list, split_num, each_duration):
-    '''
-    Get a list of sentences from responses
-    '''
-    start_seconds_list = []
-    starts_list = []
-    ends_list = []
-    texts_list = []
-    for i, response in enumerate(response_list):
-        start_seconds_list.append([sentense['start'] for sentense in response['segments']])
-        starts_list.append([seconds2SRT(sentense['start'], start_time = each_duration * i) for sentense in response['segments']])
-        ends_list.append([seconds2SRT(sentense['end'], start_time = each_duration * i) for sentense in response['segments']])
-        texts_list.append([sentense['text'] for sentense in response['segments']])
-    
-    # Delete duplicate TEXT between split tracks
-    for i in range(split_num-1):
-        del_from = len(start_seconds_list[i])
-        for j, start in enumerate(start_seconds_list[i][:-1]):
-            if start > each_duration:
-                difference = abs(start - start_seconds_list[i+1][1] - each_duration)
-
-                # Delete the part after entering the overlap part.
-                del starts_list[i][j:] 
-                del ends_list[i][j:] 
-                del texts_list[i][j:] 
-                
-                # Delete the beginning of the next track if the difference is within 2 seconds
-                if difference < 2.0:   
-                    del starts_list[i+1][:1] 
-                    del ends_list[i+1][:1] 
-                    del texts_list[i+1][:1]
-                continue
-    starts = sum(starts_list, []) # [a,b,c] = sum([[a,b], [c]], []) 
-    ends = sum(ends_list, [])
-    texts = sum(texts_list, [])
+def merge_segments(starts, ends, texts):
+    '''
+    Correct end times to the next start times and concatenate consecutive segments of the same text.
+    starts and ends are float arrays in seconds, texts is a list.
+    '''
+    n = len(texts)
+    if n == 0:
+        return np.empty(0), np.empty(0), []
+    ends = np.array(ends, dtype=float)
 
     # Corrected end time to avoid time overlap
     ends[:-1] = starts[1:]
 
+    # Concatenate if the same text is consecutive: keep the start of the first segment
+    # and the end of the last segment of each run
+    texts_array = np.empty(n, dtype=object)
+    texts_array[:] = texts
+    first = np.ones(n, dtype=bool)
+    first[1:] = texts_array[1:] != texts_array[:-1]
+    first_index = np.flatnonzero(first)
+    last_index = np.append(first_index[1:], n) - 1
+    return np.asarray(starts, dtype=float)[first_index], ends[last_index], texts_array[first_index].tolist()
 
-    # Concatenate if the same text is consecutive.
-    new_starts = starts[:1]
-    new_ends = ends[:1]
-    new_texts = texts[:1]
 
-    for i in range(1, len(starts)):
-        if new_texts[-1] == texts[i]:
-            new_ends[-1] = ends[i]
-        else:
-            new_starts.append(starts[i])
-            new_ends.append(ends[i])
-            new_texts.append(texts[i])
+class SegmentMerger:
+    '''
+    Incremental version of get_textlists.
+    Feed the responses of the split tracks in order with add(); it returns (starts, ends, texts)
+    of the segments that are final, and finish() returns the last one.
+    offsets are the start times of the tracks in the audio that was split. If non-speech parts were
+    removed from it, offset_map (an audio.OffsetMap) maps the returned times back to the original audio.
+    '''
+    def __init__(self, offsets, offset_map = None):
+        self.offsets = offsets
+        self.offset_map = offset_map
+        # Last segment waiting for the start of the next segment
+        self.starts = np.empty(0)
+        self.ends = np.empty(0)
+        self.texts = []
+
+    def add(self, i, response):
+        segments = response['segments']
+        offset = self.offsets[i]
+        starts = np.concatenate([self.starts, np.array([segment['start'] for segment in segments], dtype=float) + offset])
+        ends = np.concatenate([self.ends, np.array([segment['end'] for segment in segments], dtype=float) + offset])
+        texts = self.texts + [segment['text'] for segment in segments]
+        starts, ends, texts = merge_segments(starts, ends, texts)
+
+        self.starts, self.ends, self.texts = starts[-1:], ends[-1:], texts[-1:]
+        return self.to_original(starts[:-1], ends[:-1], texts[:-1])
+
+    def finish(self):
+        finished = self.to_original(self.starts, self.ends, self.texts)
+        self.starts, self.ends, self.texts = np.empty(0), np.empty(0), []
+        return finished
+
+    def to_original(self, starts, ends, texts):
+        if self.offset_map is None:
+            return starts, ends, texts
+        return self.offset_map.to_original(starts), self.offset_map.to_original(ends, end=True), texts
+
+
+def get_textlists(response_list, offsets, offset_map = None):
+    '''
+    Get a list of sentences from responses of the tracks starting at offsets [s].
+    Return texts and float arrays of starts and ends in seconds.
+    Times are mapped back to the original audio by offset_map (an audio.OffsetMap) if non-speech was removed.
+    '''
+    starts = np.concatenate([np.array([segment['start'] for segment in response['segments']], dtype=float) + offset
+                             for response, offset in zip(response_list, offsets)] + [np.empty(0)])
+    ends = np.concatenate([np.array([segment['end'] for segment in response['segments']], dtype=float) + offset
+                           for response, offset in zip(response_list, offsets)] + [np.empty(0)])
+    texts = [segment['text'] for response in response_list for segment in response['segments']]
+    starts, ends, texts = merge_segments(starts, ends, texts)
+    if offset_map is not None:
+        starts, ends = offset_map.to_original(starts), offset_map.to_original(ends, end=True)
+    return texts, starts, ends
 
-    starts = new_starts
-    ends = new_ends
-    texts = new_texts
 
-    return texts, starts, ends
+class SentenceAssembler:
+    '''
+    Incremental version of make_sentenses.
+    add() returns (start_times, end_times, lines) of the sentences completed by the given segments
+    and finish() returns the rest. The time of a sentence is the time of its first segment.
+    '''
+    def __init__(self):
+        self.line = ''
+        self.time = None # (start, end) of the first segment of the current line
+        self.new_time = True
+
+    def add(self, starts, ends, texts):
+        start_times = []
+        end_times = []
+        lines = []
+        for start, end, text in zip(starts, ends, texts):
+            if self.new_time == True:
+                self.time = (start, end)
+            punc = text.rfind('。')
+
+            # If the current sentence has "。”, the current sentence is added up to the rightmost "。" 
+            # to the prevous sentence, and add the rest to the list as a new sentence
+            if punc >= 0:
+                self.line += text[:punc+1]
+                start_times.append(self.time[0])
+                end_times.append(self.time[1])
+                lines.append(self.line)
+                self.line = text[punc+1:]
+                self.new_time = True
+            else:
+                self.line += text
+                self.new_time = False
+                if len(self.line) > 50:
+                    start_times.append(self.time[0])
+                    end_times.append(self.time[1])
+                    lines.append(self.line + '。')
+                    self.line = ''
+                    self.new_time = True
+        return np.array(start_times, dtype=float), np.array(end_times, dtype=float), lines
+
+    def finish(self):
+        # The last line is dropped if it has no start time
+        if self.new_time == True:
+            return np.empty(0), np.empty(0), []
+        return np.array([self.time[0]]), np.array([self.time[1]]), [self.line]
 
 
 def make_sentenses(starts, ends, texts):
     '''
     combine sentences so that they are not split in the middle
     '''
-    start_times = []
-    end_times = []
-    lines = ['']
-    new_time = True
+    assembler = SentenceAssembler()
+    start_times, end_times, lines = assembler.add(starts, ends, texts)
+    last_start, last_end, last_line = assembler.finish()
+    return np.append(start_times, last_start), np.append(end_times, last_end), lines + last_line
+
+
+def estimate_tokens(text):
+    '''
+    Rough token count without a tokenizer: about 4 ASCII characters or 1 Japanese character per token
+    '''
+    ascii_chars = sum(1 for c in text if ord(c) < 128)
+    return ascii_chars // 4 + (len(text) - ascii_chars) + 1
+
 
-    for i, (start, end, text) in enumerate(zip(starts, ends, texts)):
-        punc = list(re.finditer(r'。', text))
+def chat_payload(message, response_format = None):
+    '''
+    Get the request body of chat completion and its estimated number of tokens
+    '''
+    d = {  
+        "model": CHAT_MODEL,  
+        "messages": message,  
+        # "max_tokens": 100,  
+        "temperature": CHAT_TEMPERATURE  
+        }
+    if response_format is not None:
+        d['response_format'] = {'type': response_format}
+    # The completion is assumed to be as long as the prompt
+    tokens = 2 * sum(estimate_tokens(m['content']) for m in message)
+    return d, tokens
+
+
+def request_chat(message, api_key, rate_limiter = None, response_format = None):
+    '''
+    Request chat completion under the shared rate limiter
+    '''
+    if rate_limiter is None:
+        rate_limiter = ratelimit.get_rate_limiter(api_key, 'chat')
+    d, tokens = chat_payload(message, response_format)
+    r = client.get_client(api_key).post_json('/chat/completions', d, rate_limiter, tokens)
+    rate_limiter.reconcile(tokens, r['usage']['total_tokens'])
+    return r
 
-        if new_time == True:
-            start_times.append(start)
-            end_times.append(end)
 
-        # If the current sentence has "。”, the current sentence is added up to the rightmost "。" 
-        # to the prevous sentence, and add the rest to the list as a new sentence
-        if not (punc == []):
-            lines[-1] += text[:punc[-1].start()+1]
-            lines.append( text[punc[-1].start()+1:])
-            new_time = True
-        else:
-            lines[-1] += text
-            new_time = False
-            if len(lines[-1]) > 50:
-                lines[-1] += '。'
-                lines.append('')
-                new_time = True
-        
-
-    # Deleted the last line if lines is longer than start_times    
-    if len(lines) > len (start_times): 
-        lines = lines[:-1]
-    return start_times, end_times, lines
-
-
-def get_translation(lines_ja, api_key):
-    requested_times = [time.time() - 61.0] * 3
-
-    h = {  
-        'Content-Type': 'application/json',  
-        'Authorization': f'Bearer {api_key}' 
-    }  
-        
-    u = 'https://api.openai.com/v1/chat/completions'  
-
-    text = ''
-    
-    # Request in evry 10 sentences
-    law = 10
-    text_en = [law]
-    
-    total_token = 0
+def make_batches(lines_ja, max_tokens = 1000, max_lines = 50):
+    '''
+    Split lines into batches of up to max_tokens estimated prompt tokens and max_lines lines.
+    Return a list of (index of the first line, lines).
+    '''
+    batches = []
+    first = 0
+    tokens = 0
     for i, line in enumerate(lines_ja):
-        text +=  str(i+1) + '. ' + line + '\n '
-
-        
-        if ((i+1) % law == 0) or (i+1 == len(lines_ja)): 
-            message = [{"role": "system", "content": "The following Japanese text is segmented to lines by \\n. Translate it in brief English line by line. Use we for the first person.\n"},
-                        {"role": "user", "content": text}]
-            d = {  
-                "model": "gpt-3.5-turbo",  
-                "messages": message,  
-                # "max_tokens": 100,  
-                "temperature": 0  
-                }
-            new_time = time.time()
-            if new_time - requested_times[-3] < 61.0:
-                time.sleep(61.0 - (new_time - requested_times[-3]))
-            requested_times.append(new_time)
-
-            r = requests.post(url=u, headers=h, json=d).json()
-            token = r['usage']['total_tokens']
-            
-            total_token += token
-            text_en_temp = r['choices'][0]['message']['content']
-            
-            if text_en_temp[-2:] != '\n': text_en_temp += '\n'
-            st.write(text_en_temp)          
-            text_en.append(text_en_temp)
-                           
-            text = ''
-    return total_token, text_en
+        line_tokens = estimate_tokens(line) + 8 # JSON overhead of {"id": n, "text": ...}
+        if i > first and (tokens + line_tokens > max_tokens or i - first >= max_lines):
+            batches.append((first, lines_ja[first:i]))
+            first = i
+            tokens = 0
+        tokens += line_tokens
+    if first < len(lines_ja):
+        batches.append((first, lines_ja[first:]))
+    return batches
+
+
+def parse_translations(content, ids):
+    '''
+    Get {id: text} of the valid items of a JSON reply; items with unknown or duplicate ids are dropped
+    '''
+    try:
+        reply = json.loads(content)
+    except ValueError:
+        return {}
+    if isinstance(reply, dict):
+        reply = reply.get('translations', [])
+    if not isinstance(reply, list):
+        return {}
+
+    translations = {}
+    duplicates = set()
+    for item in reply:
+        if not isinstance(item, dict) or not isinstance(item.get('text'), str):
+            continue
+        try:
+            number = int(item.get('id'))
+        except (TypeError, ValueError):
+            continue
+        if number not in ids:
+            continue
+        if number in translations:
+            duplicates.add(number)
+        translations[number] = item['text'].replace('\n', ' ').strip()
+    for number in duplicates:
+        del translations[number]
+    return translations
+
+
+def translate_batch(lines_ja, first_number, api_key, rate_limiter = None, cache = None, max_retries = 2,
+                    manifest = None, metrics = None, language = 'en'):
+    '''
+    Translate lines numbered from first_number into language and return
+    (token, {number: translation}, numbers of the lines left untranslated).
+    The reply is requested as JSON and validated; only lines missing from it are requested again,
+    up to max_retries times, and lines still missing are left empty.
+    With cache (a cache.CompletionCache) a batch of the same lines is answered without a request
+    and counts 0 tokens. A complete batch is recorded in manifest (a jobs.JobManifest) if given,
+    so a resumed job requests the lines that were missing again.
+    '''
+    with stage(metrics, 'translation', batch=first_number, language=language):
+        return _translate_batch(lines_ja, first_number, api_key, rate_limiter, cache, max_retries, manifest, language)
+
+
+def _translate_batch(lines_ja, first_number, api_key, rate_limiter, cache, max_retries, manifest, language):
+    system = translation_system(language)
+    numbers = list(range(first_number, first_number + len(lines_ja)))
+    if manifest is not None:
+        manifest_key = f'{first_number}:' + jobs.text_key(*lines_ja)
+        if language != 'en':
+            manifest_key = f'{language}:' + manifest_key
+        recorded = manifest.get('translation', manifest_key)
+        if recorded is not None:
+            return 0, dict(zip(numbers, recorded)), []
+    if cache is not None:
+        key = cache.key(CHAT_MODEL, CHAT_TEMPERATURE, system, '\n'.join(lines_ja))
+        cached = cache.get(key)
+        if cached is not None:
+            return 0, dict(zip(numbers, json.loads(cached['content']))), []
 
+    total_token = 0
+    translations = {}
+    missing = numbers
+    for attempt in range(max_retries + 1):
+        items = [{'id': number, 'text': lines_ja[number - first_number]} for number in missing]
+        message = [{"role": "system", "content": system},
+                    {"role": "user", "content": json.dumps(items, ensure_ascii=False)}]
+        r = request_chat(message, api_key, rate_limiter, response_format='json_object')
+        total_token += r['usage']['total_tokens']
+        translations.update(parse_translations(r['choices'][0]['message']['content'], set(missing)))
+        missing = [number for number in numbers if number not in translations]
+        if not missing:
+            break
+
+    if not missing:
+        if cache is not None:
+            cache.put(key, json.dumps([translations[number] for number in numbers], ensure_ascii=False), total_token)
+        if manifest is not None:
+            manifest.put('translation', manifest_key, [translations[number] for number in numbers])
+    for number in missing:
+        translations[number] = ''
+    return total_token, translations, missing
+
+
+def translate_languages(lines_ja, first_number, api_key, languages, rate_limiter = None, cache = None,
+                        manifest = None, metrics = None):
+    '''
+    Translate one batch into every language concurrently and return
+    (token, {language: {number: translation}}, {language: numbers of the lines left untranslated}).
+    All the requests share rate_limiter and cache.
+    '''
+    def translate(language):
+        return translate_batch(lines_ja, first_number, api_key, rate_limiter, cache, manifest = manifest,
+                               metrics = metrics, language = language)
 
+    if len(languages) == 1:
+        results = [translate(languages[0])]
+    else:
+        with ThreadPoolExecutor(max_workers=len(languages)) as executor:
+            results = list(executor.map(translate, languages))
+    return (sum(token for token, translations, missing in results),
+            {language: translations for language, (token, translations, missing) in zip(languages, results)},
+            {language: missing for language, (token, translations, missing) in zip(languages, results)})
 
-def text2list(text_en, start_times):
+
+def get_translation(lines_ja, api_key, rate_limiter = None, cache = None, max_tokens = 1000, manifest = None,
+                    metrics = None, language = 'en'):
     '''
-    Get a list of sentenses from a long text with \n
-    '''
-    law = text_en[0]
-    lines_en = []
-    for k in range(1, len(text_en)):
-        if k == len(text_en)-1:
-            law = ((len(start_times) - 1)  % law) + 1
-        nums_position = list(re.finditer(r'\n\d+. ', text_en[k])) # list of positions of "\n" followed by a number and "."
-        first = re.search(r'\d+. ', text_en[k]) # position of "num."
-        
-        if len(nums_position) == 0:
-            lines_en_temp = [text_en[k][first.end():].replace('\n', '')]
-            lines_en_temp += [''] * (law - 1)
-        else:
-            lines_en_temp = [text_en[k][first.end(): nums_position[0].start()].replace('\n', '')]
-            
-            if len(nums_position) < law:
-                for i in range(len(nums_position)-1):
-                    lines_en_temp += [text_en[k][nums_position[i].end(): nums_position[i+1].start()].replace('\n', '')]
-                lines_en_temp.append(text_en[k][nums_position[len(nums_position)-1].end():].replace('\n', ''))
-                lines_en_temp += [''] * (law - len(nums_position) - 1)
-            else:
-                for i in range(law-2):
-                    lines_en_temp += [text_en[k][nums_position[i].end(): nums_position[i+1].start()].replace('\n', '')]
-                for i in range(law-2, len(nums_position)-1):
-                    lines_en_temp[-1] += ' ' + text_en[k][nums_position[i].end(): nums_position[i+1].start()].replace('\n', '')
-                lines_en_temp[-1] += ' ' + text_en[k][nums_position[len(nums_position)-1].end():].replace('\n', '')
-                
-        lines_en += lines_en_temp
+    Translate lines in batches of up to max_tokens and return (total token, list of {number: translation}).
+    Lines left untranslated are empty.
+    '''
+    text_en = []
+    total_token = 0
+    for first, lines in make_batches(lines_ja, max_tokens):
+        token, translations, missing = translate_batch(lines, first + 1, api_key, rate_limiter, cache, manifest = manifest,
+                                              metrics = metrics, language = language)
+        total_token += token
+        text_en.append(translations)
+    return total_token, text_en
 
-    return lines_en
 
-def get_summary(lines_en,  api_key, summarize_ratio = 0.1, batch_size = 100): 
+def stream_subtitles(file_paths, offsets, api_key, prompt, max_workers = 4, max_tokens = 1000,
+                     audio_limiter = None, chat_limiter = None, transcription_cache = None,
+                     translation_cache = None, manifest = None, metrics = None, languages = ('en',),
+                     offset_map = None):
     '''
-    Make sumamry
+    Streaming pipeline of get_transcribe, get_textlists, make_sentenses and get_translation.
+    Each transcribed track is de-duplicated, assembled into sentences and translated as soon as it
+    arrives, while the later tracks are still being transcribed. Yield in order
+      {'chunk': index, 'duration': seconds, 'error': message or None} for each track and
+      {'batch': index, 'start_times', 'end_times', 'lines_ja', 'translations', 'missing', 'token'} for each
+    translated batch, with start_times and end_times as float arrays in seconds, translations as
+    {language: {number: text}} and missing as {language: numbers of the lines left untranslated}.
+    Each batch is translated into all languages concurrently by translate_languages.
+    Batches are made by make_batches, and only the last, possibly incomplete batch waits for the next track.
+    The list of translations of a language over the batches is the input of text2list.
+    With manifest (a jobs.JobManifest) transcribed tracks and translated batches are recorded,
+    and a restarted job only requests the ones that are missing.
+    Transcriptions, merging, sentence assembly and translations are stages of metrics (a metrics.RunMetrics) if given.
+    If non-speech was removed before splitting, offset_map (an audio.OffsetMap) maps the times back to the original.
     '''
+    merger = SegmentMerger(offsets, offset_map)
+    assembler = SentenceAssembler()
+    start_times = np.empty(0)
+    end_times = np.empty(0)
+    lines = []
+    batch = 0
+    translated = 0 # number of lines already translated
+
+    chunks = iter_transcribe(file_paths, api_key, prompt, max_workers, audio_limiter, transcription_cache, manifest,
+                             metrics)
+    for i, response, error in chunks:
+        yield {'chunk': i, 'duration': response['duration'], 'error': error}
+        last = i == len(file_paths) - 1
+        with stage(metrics, 'merge', chunk=i):
+            merged = [merger.add(i, response)]
+            if last:
+                merged.append(merger.finish())
+        with stage(metrics, 'sentences', chunk=i):
+            parts = [assembler.add(*part) for part in merged]
+            if last:
+                parts.append(assembler.finish())
+        start_times = np.concatenate([start_times] + [part[0] for part in parts])
+        end_times = np.concatenate([end_times] + [part[1] for part in parts])
+        lines += [line for part in parts for line in part[2]]
+
+        batches = make_batches(lines, max_tokens)
+        if not last:
+            batches = batches[:-1]
+        for first, batch_lines in batches:
+            n = len(batch_lines)
+            token, translations, missing = translate_languages(batch_lines, translated + 1, api_key, list(languages),
+                                                               chat_limiter, translation_cache, manifest, metrics)
+            yield {'batch': batch,
+                   'start_times': start_times[:n],
+                   'end_times': end_times[:n],
+                   'lines_ja': batch_lines,
+                   'translations': translations,
+                   'missing': missing,
+                   'token': token}
+            start_times, end_times, lines = start_times[n:], end_times[n:], lines[n:]
+            translated += n
+            batch += 1
+
 
-    h = {  
-        'Content-Type': 'application/json',  
-        'Authorization': f'Bearer {api_key}' 
-    }  
-        
-    u = 'https://api.openai.com/v1/chat/completions'  
 
-    text = ''
-    summary_en = ''
+def text2list(text_en, start_times):
+    '''
+    Get a list of translated lines aligned with start_times from the translated batches of one language
+    '''
+    translations = {}
+    for batch in text_en:
+        translations.update(batch)
+    return [translations.get(i+1, '') for i in range(len(start_times))]
+
+def summarize_text(text, system, api_key, rate_limiter = None, cache = None, manifest = None, metrics = None):
+    '''
+    Summarize text with a system message and return (token, summary); cache hits count 0 tokens.
+    The summary is recorded in manifest (a jobs.JobManifest) if given.
+    '''
+    with stage(metrics, 'summary'):
+        return _summarize_text(text, system, api_key, rate_limiter, cache, manifest)
+
+
+def _summarize_text(text, system, api_key, rate_limiter, cache, manifest):
+    if manifest is not None:
+        manifest_key = jobs.text_key(system, text)
+        recorded = manifest.get('summary', manifest_key)
+        if recorded is not None:
+            return 0, recorded
+
+    if cache is not None:
+        key = cache.key(CHAT_MODEL, CHAT_TEMPERATURE, system, text)
+        cached = cache.get(key)
+        if cached is not None:
+            return 0, cached['content']
+
+    message = [{"role": "system", "content": system},
+                {"role": "user", "content": text}]
+    r = request_chat(message, api_key, rate_limiter)
+    token = r['usage']['total_tokens']
+    summary = r['choices'][0]['message']['content']
+    if cache is not None:
+        cache.put(key, summary, token)
+    if manifest is not None:
+        manifest.put('summary', manifest_key, summary)
+    return token, summary
+
+
+def get_summary(lines_en,  api_key, summarize_ratio = 0.1, batch_size = 100, rate_limiter = None,
+                cache = None, max_tokens = 2000, max_workers = 4, manifest = None, metrics = None):
+    '''
+    Make sumamry by map-reduce.
+    Map: batches of up to max_tokens and batch_size lines are summarized to summarize_ratio concurrently.
+    Reduce: partial summaries are grouped up to max_tokens and combined level by level, also concurrently,
+    until one summary is left. A level that does not fit in one group is shortened so that the next one
+    fits, so the number of levels grows with log(length).
+    Partial summaries are reused from cache (a cache.CompletionCache) and manifest (a jobs.JobManifest) if given.
+    '''
     total_token = 0
-    requested_times = [time.time()-61.0] * 3
-
-    for i, line in enumerate(lines_en):
-        text +=  line
-
-        # Request for batch_size of lines
-        if ((i+1) % batch_size == 0) or (i+1 == len(lines_en)):
-
-            message = [{"role": "system", "content": f"Summarize the following text to {int(summarize_ratio * 100)}% length. Use we for the first person.\n"},
-                        {"role": "user", "content": text}]
-            d = {  
-                "model": "gpt-3.5-turbo",  
-                "messages": message,  
-                # "max_tokens": 100,  
-                "temperature": 0  
-                }
-            
-            new_time = time.time()
-            if new_time - requested_times[-3] < 61.0:
-                print('wait for ready', 61.0 - (new_time - requested_times[-3]), '[s]')
-                time.sleep(61.0 - (new_time - requested_times[-3]))
-            requested_times.append(new_time)
-
-            r = requests.post(url=u, headers=h, json=d).json()
-            token = r['usage']['total_tokens']
-            print('token:', token)
-            total_token += token
-            summary_en += r['choices'][0]['message']['content']
-            text = ''
-    if len(lines_en) > batch_size:
-        message = [{"role": "system", "content": f"Summarize the following text to {summarize_ratio}% length. Use we for the first person.\n"},
-                    {"role": "user", "content": summary_en}]
-        d = {  
-            "model": "gpt-3.5-turbo",  
-            "messages": message,  
-            # "max_tokens": 100,  
-            "temperature": 0  
-            }
-        
-        new_time = time.time()
-        if new_time - requested_times[-3] < 61.0:
-            print('wait for ready', 61.0 - (new_time - requested_times[-3]), '[s]')
-            time.sleep(61.0 - (new_time - requested_times[-3]))
-            
-        requested_times.append(new_time)
-
-        r = requests.post(url=u, headers=h, json=d).json()
-        token = r['usage']['total_tokens']
-        print('token:', token)
-        total_token += token
-        summary_en = r['choices'][0]['message']['content']
-    return total_token, summary_en
+
+    def summarize_all(texts, system):
+        nonlocal total_token
+        with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(texts)))) as executor:
+            results = list(executor.map(lambda text: summarize_text(text, system, api_key, rate_limiter, cache, manifest,
+                                                                    metrics), texts))
+        total_token += sum(token for token, summary in results)
+        return [summary for token, summary in results]
+
+    texts = [' '.join(lines) for first, lines in make_batches(lines_en, max_tokens, batch_size)]
+    if not texts:
+        return 0, ''
+    summaries = summarize_all(texts, f"Summarize the following text to {int(summarize_ratio * 100)}% length. Use we for the first person.\n")
+
+    while len(summaries) > 1:
+        groups = [' '.join(group) for first, group in make_batches(summaries, max_tokens, len(summaries))]
+        if len(groups) == len(summaries):
+            # Every summary is over the budget: combine them in pairs so that the tree still shrinks
+            groups = [' '.join(summaries[i:i+2]) for i in range(0, len(summaries), 2)]
+        if len(groups) == 1:
+            system = "Combine the following partial summaries into one summary. Use we for the first person.\n"
+        else:
+            total = sum(estimate_tokens(summary) for summary in summaries)
+            ratio = max(summarize_ratio, min(1.0, max_tokens / total))
+            system = f"Combine the following partial summaries into one summary of {int(ratio * 100)}% length. Use we for the first person.\n"
+        summaries = summarize_all(groups, system)
+    return total_token, summaries[0]
 
 
 
 def make_srt(starts, ends, texts, mp3_file_path, language = 'en'):
-    srt = ''
-    for i, (start, end, text) in enumerate(zip(starts, ends, texts)):
-        srt += str(i+1) + '\n' + start + ' --> ' + end + '\n' +text + '\n\n'
-    srt += '\n'
+    '''
+    Write an SRT file from starts and ends in seconds
+    '''
+    writer = artifacts.SRTWriter()
+    writer.add(starts, ends, texts)
+    srt = writer.getvalue()
     if language == 'en':
         output_file_name = mp3_file_path[:-4]+'_en.srt'
     else: 
         output_file_name = mp3_file_path[:-4]+'_ja.srt'
     with open(output_file_name, 'w', encoding='utf-8') as f:
         f.write(srt)
-    f.close()
     return srt
 
 
 
 def make_csv(starts, ends, texts, mp3_file_path, language = 'en'):
-    csv_data = [[i+1,start, end, text] for i, (start, end, text) in enumerate(zip(starts, ends, texts))]
+    '''
+    Write a CSV file from starts and ends in seconds
+    '''
+    writer = artifacts.CSVWriter()
+    writer.add(starts, ends, texts)
     if language == 'en':
         output_file_name = mp3_file_path[:-4]+'_en.csv'
     else: 
         output_file_name = mp3_file_path[:-4]+'_ja.csv'
-    with open(output_file_name, 'w' , encoding='utf_8_sig') as f:
-        writer = csv.writer(f, lineterminator='\n')
-        writer.writerows(csv_data)
-        f.close()
-    return csv_data
-
+    with open(output_file_name, 'wb') as f:
+        f.write(writer.getbytes())
+    return writer.getvalue()